@@ -33,6 +33,7 @@ from bpy.app.handlers import persistent
 from . import humanoid, animationengine, proxyengine
 from . import facerig
 import time
+import functools
 import ctypes
 import sys
 import platform
@@ -47,10 +48,15 @@ gui_status = "NEW_SESSION"
 gui_err_msg = ""
 gui_active_panel = None
 gui_active_panel_fin = None
+session_loader = None
+realtime_pending_categories = set()
+realtime_last_change = 0.0
+realtime_followups_pending = False
+realtime_timer_registered = False
 
 def start_lab_session():
 
-    global mblab_humanoid
+    global mblab_humanoid,session_loader
     global gui_status,gui_err_msg
 
     algorithms.print_log_report("INFO","Start_the lab session...")
@@ -76,6 +82,18 @@ def start_lab_session():
         gui_err_msg = is_obj[1]
         return
 
+    if is_obj[0] == "FOUND":
+        obj = algorithms.get_object_by_name(is_obj[1])
+        character_identifier = obj["manuellab_id"]
+        rigging_type = obj["manuellab_rig"]
+        is_existing = True
+
+    #The databases are loaded in background while
+    #the main thread imports the model from the library
+    if session_loader:
+        session_loader.shutdown()
+    session_loader = mblab_humanoid.preload_databases(character_identifier, rigging_type)
+
     if is_obj[0] == "NO_OBJ":
         base_model_name = mblab_humanoid.characters_config[character_identifier]["template_model"]
         obj = algorithms.import_object_from_lib(lib_filepath, base_model_name, character_identifier)
@@ -83,57 +101,127 @@ def start_lab_session():
         obj["manuellab_id"] = character_identifier
         obj["manuellab_rig"] = rigging_type
 
-    if is_obj[0] == "FOUND":
-        obj = algorithms.get_object_by_name(is_obj[1])
-        character_identifier = obj["manuellab_id"]
-        rigging_type = obj["manuellab_rig"]
-        is_existing = True
-
     if not obj:
         algorithms.print_log_report("CRITICAL","Init failed...")
         gui_status = "ERROR_SESSION"
         gui_err_msg = "Init failed. Check the log file"
+        session_loader.shutdown()
+        session_loader = None
     else:
-        mblab_humanoid.init_database(obj,character_identifier,rigging_type)
-        if mblab_humanoid.has_data:
-            gui_status = "ACTIVE_SESSION"
+        gui_status = "LOADING_SESSION"
+        bpy.app.timers.register(
+            functools.partial(finish_lab_session, obj.name, character_identifier, rigging_type, is_existing),
+            first_interval=0.05)
 
-            if scn.mblab_use_cycles or scn.mblab_use_eevee:
-                if scn.mblab_use_cycles:
-                    scn.render.engine = 'CYCLES'
+
+def finish_lab_session(obj_name, character_identifier, rigging_type, is_existing):
+    """
+    Timer that waits for the background loading and then
+    completes the session on the main thread.
+    """
+    global mblab_humanoid,session_loader
+    global gui_status,gui_err_msg
+
+    if not session_loader:
+        return None
+    if not session_loader.is_done():
+        return 0.05
+
+    scn = bpy.context.scene
+    lib_filepath = algorithms.get_blendlibrary_path()
+    data_loader = session_loader
+    session_loader = None
+    obj = algorithms.get_object_by_name(obj_name)
+
+    try:
+        if not obj:
+            algorithms.print_log_report("CRITICAL","Init failed...")
+            gui_status = "ERROR_SESSION"
+            gui_err_msg = "Init failed. Check the log file"
+        else:
+            mblab_humanoid.init_database(obj,character_identifier,rigging_type,data_loader)
+            if mblab_humanoid.has_data:
+                gui_status = "ACTIVE_SESSION"
+
+                if scn.mblab_use_cycles or scn.mblab_use_eevee:
+                    if scn.mblab_use_cycles:
+                        scn.render.engine = 'CYCLES'
+                    else:
+                        scn.render.engine = 'BLENDER_EEVEE'
+                    if scn.mblab_use_lamps:
+                        algorithms.import_object_from_lib(lib_filepath, "Lamp_back_bottom")
+                        algorithms.import_object_from_lib(lib_filepath, "Lamp_back_up")
+                        algorithms.import_object_from_lib(lib_filepath, "Lamp_left")
+                        algorithms.import_object_from_lib(lib_filepath, "Lamp_right")
+                        #algorithms.append_object_from_library(lib_filepath, [], "Lamp_")
                 else:
-                    scn.render.engine = 'BLENDER_EEVEE'
-                if scn.mblab_use_lamps:
-                    algorithms.import_object_from_lib(lib_filepath, "Lamp_back_bottom")
-                    algorithms.import_object_from_lib(lib_filepath, "Lamp_back_up")
-                    algorithms.import_object_from_lib(lib_filepath, "Lamp_left")
-                    algorithms.import_object_from_lib(lib_filepath, "Lamp_right")
-                    #algorithms.append_object_from_library(lib_filepath, [], "Lamp_")
-            else:
-                scn.render.engine = 'BLENDER_WORKBENCH'
-
-            algorithms.print_log_report("INFO","Rendering engine now is {0}".format(scn.render.engine))
-            init_morphing_props(mblab_humanoid)
-            init_categories_props(mblab_humanoid)
-            init_measures_props(mblab_humanoid)
-            init_restposes_props(mblab_humanoid)
-            init_presets_props(mblab_humanoid)
-            init_ethnic_props(mblab_humanoid)
-            init_metaparameters_props(mblab_humanoid)
-            init_material_parameters_props(mblab_humanoid)
-            mblab_humanoid.update_materials()
-
-            if is_existing:
-                algorithms.print_log_report("INFO","Re-init the character {0}".format(obj.name))
-                mblab_humanoid.store_mesh_in_cache()
-                mblab_humanoid.reset_mesh()
-                mblab_humanoid.recover_prop_values_from_obj_attr()
-                mblab_humanoid.restore_mesh_from_cache()
+                    scn.render.engine = 'BLENDER_WORKBENCH'
+
+                algorithms.print_log_report("INFO","Rendering engine now is {0}".format(scn.render.engine))
+                init_morphing_props(mblab_humanoid)
+                init_categories_props(mblab_humanoid)
+                init_measures_props(mblab_humanoid)
+                init_restposes_props(mblab_humanoid)
+                init_presets_props(mblab_humanoid)
+                init_ethnic_props(mblab_humanoid)
+                init_metaparameters_props(mblab_humanoid)
+                init_material_parameters_props(mblab_humanoid)
+                mblab_humanoid.update_materials()
+
+                if is_existing:
+                    algorithms.print_log_report("INFO","Re-init the character {0}".format(obj.name))
+                    mblab_humanoid.store_mesh_in_cache()
+                    mblab_humanoid.reset_mesh()
+                    mblab_humanoid.recover_prop_values_from_obj_attr()
+                    mblab_humanoid.restore_mesh_from_cache()
+                else:
+                    mblab_humanoid.reset_mesh()
+                    mblab_humanoid.update_character(mode = "update_all")
+
+                algorithms.deselect_all_objects()
+                push_undo_step("Create character")
             else:
-                mblab_humanoid.reset_mesh()
-                mblab_humanoid.update_character(mode = "update_all")
+                gui_status = "ERROR_SESSION"
+                gui_err_msg = "Init failed. Check the log file"
+    except Exception as e:
+        #The timer can't report the error to an operator: the
+        #session is closed and the panel shows the error
+        algorithms.print_log_report("CRITICAL","Init failed: {0}".format(e))
+        mblab_humanoid.has_data = False
+        gui_status = "ERROR_SESSION"
+        gui_err_msg = "Init failed. Check the log file"
+    finally:
+        data_loader.report_timings()
+        data_loader.shutdown()
+        redraw_lab_panels()
+    return None
 
-            algorithms.deselect_all_objects()
+
+def push_undo_step(message):
+    """
+    Push an undo step from a timer. In some Blender versions the
+    timers have no window in the context, so one is provided.
+    """
+    if bpy.ops.ed.undo_push.poll():
+        bpy.ops.ed.undo_push(message=message)
+        return
+    windows = bpy.context.window_manager.windows
+    if not windows:
+        algorithms.print_log_report("WARNING","Undo step not available: {0}".format(message))
+        return
+    override = {"window": windows[0], "screen": windows[0].screen}
+    if hasattr(bpy.context, "temp_override"):
+        with bpy.context.temp_override(**override):
+            bpy.ops.ed.undo_push(message=message)
+    else:
+        bpy.ops.ed.undo_push(override, message=message)
+
+
+def redraw_lab_panels():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
 
 
 
@@ -142,7 +230,12 @@ def start_lab_session():
 def check_manuelbastionilab_session(dummy):
     global mblab_humanoid
     global gui_status, gui_err_msg
+    global realtime_followups_pending,realtime_timer_registered
     scn = bpy.context.scene
+    #Loading a file removes the timers, including the realtime one
+    realtime_pending_categories.clear()
+    realtime_followups_pending = False
+    realtime_timer_registered = False
     if mblab_humanoid:
         # init_femaleposes_props()
         # init_maleposes_props()
@@ -163,20 +256,75 @@ bpy.app.handlers.load_post.append(check_manuelbastionilab_session)
 def sync_character_to_props():
     #It's important to avoid problems with Blender undo system
     global mblab_humanoid
+    flush_realtime_updates()
     mblab_humanoid.sync_character_data_to_obj_props()
     mblab_humanoid.update_character()
 
 def realtime_update(self, context):
     """
     Update the character while the prop slider moves.
+    The changes are collected and applied by a timer, so a
+    fast drag produces at most one update for each interval.
     """
     global mblab_humanoid
+    global realtime_last_change,realtime_timer_registered
     if mblab_humanoid.bodydata_realtime_activated:
-        #time1 = time.time()
         scn = bpy.context.scene
-        mblab_humanoid.update_character(category_name = scn.morphingCategory, mode="update_realtime")
-        mblab_humanoid.sync_gui_according_measures()
-        #print("realtime_update: {0}".format(time.time()-time1))
+        latency = scn.mblab_realtime_latency
+        if latency <= 0:
+            mblab_humanoid.update_character(category_name = scn.morphingCategory, mode="update_realtime")
+            mblab_humanoid.sync_gui_according_measures()
+            return
+        realtime_pending_categories.add(scn.morphingCategory)
+        realtime_last_change = time.time()
+        if not realtime_timer_registered:
+            realtime_timer_registered = True
+            bpy.app.timers.register(process_realtime_updates, first_interval=latency)
+
+def process_realtime_updates():
+    """
+    Timer that applies the pending morph changes. The armature,
+    the normals and the measures are updated only when no change
+    arrives for the latency interval, that is when the drag stops.
+    """
+    global mblab_humanoid
+    global realtime_followups_pending,realtime_timer_registered
+    latency = max(bpy.context.scene.mblab_realtime_latency, 0.01)
+    if not mblab_humanoid.has_data or not mblab_humanoid.get_object():
+        realtime_pending_categories.clear()
+        realtime_followups_pending = False
+        realtime_timer_registered = False
+        return None
+
+    if realtime_pending_categories:
+        for category_name in sorted(realtime_pending_categories):
+            mblab_humanoid.update_character(category_name = category_name, mode="update_realtime_morphs")
+        realtime_pending_categories.clear()
+        realtime_followups_pending = True
+        return latency
+
+    if realtime_followups_pending:
+        waiting_time = time.time()-realtime_last_change
+        if waiting_time < latency:
+            return latency-waiting_time
+        mblab_humanoid.finish_realtime_update()
+        realtime_followups_pending = False
+
+    realtime_timer_registered = False
+    return None
+
+def flush_realtime_updates():
+    """
+    Apply immediately the changes still waiting for the timer.
+    """
+    global mblab_humanoid
+    global realtime_followups_pending
+    if realtime_pending_categories or realtime_followups_pending:
+        for category_name in sorted(realtime_pending_categories):
+            mblab_humanoid.update_character(category_name = category_name, mode="update_realtime_morphs")
+        realtime_pending_categories.clear()
+        mblab_humanoid.finish_realtime_update()
+        realtime_followups_pending = False
 
 def age_update(self, context):
     global mblab_humanoid
@@ -555,6 +703,19 @@ bpy.types.Scene.mblab_measure_filter = bpy.props.StringProperty(
     default = "",
     description="Filter the measures to show")
 
+bpy.types.Scene.mblab_measures_least_squares = bpy.props.BoolProperty(
+    name="Fit all measures together",
+    default = False,
+    description="Fit the measures solving a single least squares problem, so the modifiers that affect the same measures do not conflict")
+
+bpy.types.Scene.mblab_realtime_latency = bpy.props.FloatProperty(
+    name="Update latency",
+    min=0.0,
+    max=1.0,
+    default = 0.05,
+    precision=3,
+    description="Seconds between two updates of the mesh while a slider moves. The armature and the measures are updated when the slider stops. Zero updates everything at each change")
+
 bpy.types.Scene.mblab_expression_filter = bpy.props.StringProperty(
     name="Filter",
     default = "",
@@ -1566,7 +1727,8 @@ class ApplyMeasures(bpy.types.Operator):
 
     def execute(self, context):
         global mblab_humanoid
-        mblab_humanoid.automodelling(use_measures_from_GUI=True)
+        scn = bpy.context.scene
+        mblab_humanoid.automodelling(use_measures_from_GUI=True, least_squares=scn.mblab_measures_least_squares)
         return {'FINISHED'}
 
 
@@ -1583,7 +1745,8 @@ class AutoModelling(bpy.types.Operator):
 
     def execute(self, context):
         global mblab_humanoid
-        mblab_humanoid.automodelling(use_measures_from_current_obj=True)
+        scn = bpy.context.scene
+        mblab_humanoid.automodelling(use_measures_from_current_obj=True, least_squares=scn.mblab_measures_least_squares)
         return {'FINISHED'}
 
 class AutoModellingMix(bpy.types.Operator):
@@ -1599,7 +1762,8 @@ class AutoModellingMix(bpy.types.Operator):
 
     def execute(self, context):
         global mblab_humanoid
-        mblab_humanoid.automodelling(use_measures_from_current_obj=True, mix = True)
+        scn = bpy.context.scene
+        mblab_humanoid.automodelling(use_measures_from_current_obj=True, mix = True, least_squares=scn.mblab_measures_least_squares)
         return {'FINISHED'}
 
 class SaveRestPose(bpy.types.Operator, ExportHelper):
@@ -1758,7 +1922,8 @@ class StartSession(bpy.types.Operator):
     bl_label = "Create character"
     bl_description = 'Create the character selected above'
     bl_context = 'objectmode'
-    bl_options = {'REGISTER', 'INTERNAL','UNDO'}
+    #The character is completed by a timer, which pushes the undo step
+    bl_options = {'REGISTER', 'INTERNAL'}
 
     def execute(self, context):
         start_lab_session()
@@ -1805,6 +1970,10 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
             box = self.layout.box()
             box.label(text=gui_err_msg, icon="INFO")
 
+        if gui_status == "LOADING_SESSION":
+            box = self.layout.box()
+            box.label(text="Loading the character databases...", icon="TIME")
+
         if gui_status == "NEW_SESSION":
             #box = self.layout.box()
 
@@ -1822,7 +1991,7 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
                 self.layout.prop(scn,'mblab_use_lamps')
             self.layout.operator('mbast.init_character')
 
-        if gui_status != "ACTIVE_SESSION":
+        if gui_status not in ("ACTIVE_SESSION", "LOADING_SESSION"):
             self.layout.label(text=" ")
             self.layout.label(text="AFTER-CREATION TOOLS")
 
@@ -2026,6 +2195,7 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
                     mblab_humanoid.bodydata_realtime_activated = True
                     if mblab_humanoid.exists_measure_database():
                         box.prop(scn, 'mblab_show_measures')
+                    box.prop(scn, 'mblab_realtime_latency')
                     split = box.split()
 
                     col = split.column()
@@ -2042,6 +2212,7 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
                         col.label(text="Experimental feature", icon = 'ERROR')
                         col.prop(obj, 'mblab_use_inch')
                         col.prop(scn, 'mblab_measure_filter')
+                        col.prop(scn, 'mblab_measures_least_squares')
                         col.operator("mbast.measures_apply")
 
                         m_unit = "cm"
@@ -2067,6 +2238,7 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
                     else:
                         self.layout.operator('mbast.button_automodelling_off', icon=icon_collapse)
                         box = self.layout.box()
+                        box.prop(scn, 'mblab_measures_least_squares')
                         box.operator("mbast.auto_modelling")
                         box.operator("mbast.auto_modelling_mix")
                 else:
@@ -15,12 +15,17 @@
 
 import mathutils
 import itertools
-import random
 import time
 import os
+import sys
 import bpy
+import bmesh
 import json
 import array
+import numpy
+import marshal
+import hashlib
+import threading
 
 
 debug_level = 3
@@ -53,6 +58,22 @@ def get_data_path():
         print_log_report("CRITICAL","Tools data not found. Please check your Blender addons directory.")
         return None
 
+def get_cache_path():
+    """
+    Return the folder of the compiled databases, creating it if needed.
+    """
+    data_path = get_data_path()
+    if data_path:
+        cache_dir = os.path.join(data_path, "cache")
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError:
+                print_log_report("WARNING","Cannot create the cache folder {0}".format(simple_path(cache_dir)))
+                return None
+        return cache_dir
+    return None
+
 def get_configuration():
     data_path = get_data_path()
     if data_path:
@@ -91,20 +112,6 @@ def json_booleans_to_python(value):
 def quick_dist(p_1, p_2):
     return ((p_1[0]-p_2[0])**2) + ((p_1[1]-p_2[1])**2) + ((p_1[2]-p_2[2])**2)
 
-def full_dist(vert1, vert2, axis="ALL"):
-    v1 = mathutils.Vector(vert1)
-    v2 = mathutils.Vector(vert2)
-
-    if axis not in ["X","Y","Z"]:
-        v3 = v1-v2
-        return v3.length
-    if axis == "X":
-        return abs(v1[0]-v2[0])
-    if axis == "Y":
-        return abs(v1[1]-v2[1])
-    if axis == "Z":
-        return abs(v1[2]-v2[2])
-
 def exists_database(lib_path):
     result = False
     if simple_path(lib_path) != "":
@@ -122,14 +129,6 @@ def exists_database(lib_path):
     return result
 
 
-def length_of_strip(vertices_coords, indices, axis="ALL"):
-    strip_length = 0
-    for x in range(len(indices)-1):
-        v1 = vertices_coords[indices[x]]
-        v2 = vertices_coords[indices[x+1]]
-        strip_length += full_dist(v1,v2, axis)
-    return(strip_length)
-
 def function_modifier_a(val_x):
     val_y = 0.0
     if val_x > 0.5:
@@ -254,25 +253,24 @@ def is_excluded(property_name, excluded_properties):
     return False
 
 
-def generate_parameter(val, random_value, preserve_phenotype=False):
-
+def generate_parameters(values, random_value, preserve_phenotype=False, random_generator=numpy.random):
+    """
+    Return random values for the array of parameters. If the
+    phenotype is preserved, each value stays on its side of 0.5.
+    """
+    random_values = random_generator.random_sample(len(values))
     if preserve_phenotype:
-        if val > 0.5:
-            if val > 0.8:
-                new_value = 0.8 + 0.2*random.random()
-            else:
-                new_value = 0.5+random.random()*random_value
-        else:
-            if val < 0.2:
-                new_value = 0.2*random.random()
-            else:
-                new_value = 0.5-random.random()*random_value
+        new_values = numpy.where(
+            values > 0.5,
+            numpy.where(values > 0.8, 0.8+0.2*random_values, 0.5+random_values*random_value),
+            numpy.where(values < 0.2, 0.2*random_values, 0.5-random_values*random_value))
     else:
-        if random.random() > 0.5:
-            new_value = min(1.0, 0.5+random.random()*random_value)
-        else:
-            new_value = max(0.0, 0.5-random.random()*random_value)
-    return new_value
+        random_signs = random_generator.random_sample(len(values)) > 0.5
+        new_values = numpy.where(
+            random_signs,
+            numpy.minimum(1.0, 0.5+random_values*random_value),
+            numpy.maximum(0.0, 0.5-random_values*random_value))
+    return new_values
 
 
 def polygon_forma(list_of_verts):
@@ -314,46 +312,90 @@ def linear_interpolation_y(xa,xb,ya,yb,y):
     return (((xa-xb)*y)+(xb*ya)-(xa*yb))/(ya-yb)
 
 
-def correct_morph(base_form, current_form, morph_deltas, bboxes):
-    time1 = time.time()
-    new_morph_deltas = []
-    for d_data in morph_deltas:
-
-        idx = d_data[0]
-
-        if str(idx) in bboxes:
-            indices = bboxes[str(idx)]
-            current_bounding_box = bounding_box(current_form, indices)
-            if current_bounding_box:
-                base_bounding_box = bounding_box(base_form, indices)
-                if base_bounding_box:
-
-                    if base_bounding_box[0] != 0:
-                        scale_x = current_bounding_box[0]/base_bounding_box[0]
-                    else:
-                        scale_x = 1
-
-                    if base_bounding_box[1] != 0:
-                        scale_y = current_bounding_box[1]/base_bounding_box[1]
-                    else:
-                        scale_y = 1
-
-                    if base_bounding_box[2] != 0:
-                        scale_z = current_bounding_box[2]/base_bounding_box[2]
-                    else:
-                        scale_z = 1
-
-                    delta_x = d_data[1][0] * scale_x
-                    delta_y = d_data[1][1] * scale_y
-                    delta_z = d_data[1][2] * scale_z
+def bounded_least_squares(matrix, targets, lower, upper, tolerance=1e-10):
+    """
+    Minimize |matrix·x - targets| with lower <= x <= upper, using the
+    active set method of Lawson-Hanson extended to two bounds. The
+    variables at a bound are fixed and the problem is solved on the
+    free ones; a fixed variable is released when the gradient pushes
+    it inside the bounds. Starting from x = 0, lstsq keeps the free
+    variables with minimum norm when the problem is underdetermined.
+    """
+    n_vars = matrix.shape[1]
+    x = numpy.clip(numpy.zeros(n_vars), lower, upper)
+    fixed = numpy.zeros(n_vars, dtype=bool)
+    for iteration in range(3*n_vars+1):
+        #Solve on the free variables, stepping back to the bounds
+        while True:
+            free = ~fixed
+            z = x.copy()
+            if free.any():
+                residual_targets = targets - matrix[:, fixed].dot(x[fixed])
+                z[free] = numpy.linalg.lstsq(matrix[:, free], residual_targets, rcond=None)[0]
+            out_of_bounds = free & ((z < lower-tolerance) | (z > upper+tolerance))
+            if not out_of_bounds.any():
+                x = numpy.clip(z, lower, upper)
+                break
+            direction = z-x
+            bounds = numpy.where(direction > 0, upper, lower)
+            steps = (bounds[out_of_bounds]-x[out_of_bounds])/direction[out_of_bounds]
+            x = numpy.clip(x+steps.min()*direction, lower, upper)
+            fixed |= free & ((x <= lower+tolerance) | (x >= upper-tolerance)) & out_of_bounds
+            fixed[numpy.flatnonzero(out_of_bounds)[numpy.argmin(steps)]] = True
+
+        gradient = matrix.T.dot(matrix.dot(x)-targets)
+        releasable = fixed & (((x <= lower+tolerance) & (gradient < -tolerance)) |
+                              ((x >= upper-tolerance) & (gradient > tolerance)))
+        if not releasable.any():
+            break
+        candidates = numpy.flatnonzero(releasable)
+        fixed[candidates[numpy.argmax(numpy.abs(gradient[candidates]))]] = False
+    return x
+
+def bounding_boxes_extents(verts_coo, bbox_indices, roundness=4):
+    """
+    Vectorized version of bounding_box for all the rows of the
+    (K x 6) bbox_indices. The rows with an index not in verts_coo are nan.
+    """
+    in_range = numpy.all(bbox_indices < len(verts_coo), axis=1)
+    if not numpy.all(in_range):
+        print_log_report("WARNING","Error in calculating bounding boxes: {0} boxes with indices not in verts_coo (len(verts_coo) = {1})".format(
+            numpy.count_nonzero(~in_range),len(verts_coo)))
+    box_coords = numpy.asarray(verts_coo, dtype=numpy.float64)[numpy.where(in_range[:, None], bbox_indices, 0)]
+    extents = numpy.round(box_coords.max(axis=1)-box_coords.min(axis=1), roundness)
+    extents[~in_range] = numpy.nan
+    return extents
+
+def bounding_boxes_scales(base_extents, current_extents):
+    """
+    Return the (K x 3) scale factors between the current and the
+    base boxes. The axes with a null base extent are not scaled.
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        scales = numpy.where(base_extents != 0, current_extents/base_extents, 1.0)
+    scales[numpy.isnan(base_extents).any(axis=1) | numpy.isnan(current_extents).any(axis=1)] = numpy.nan
+    return scales
 
-                    newd = mathutils.Vector((delta_x, delta_y, delta_z))
-                    new_morph_deltas.append([idx, newd])
-        else:
-            new_morph_deltas.append(d_data)
-            print_log_report("WARNING","Index {0} not in bounding box database".format(idx))
+def correct_morph(morph_data, bboxes, scale_factors):
+    """
+    Scale the deltas of the morph according the bounding box of
+    each vertex. The scale_factors are computed for all the boxes
+    by bounding_boxes_scales.
+    """
+    time1 = time.time()
+    morph_indices, morph_deltas = morph_data
+    rows = bboxes.get_rows(morph_indices)
+    in_database = rows >= 0
+    for idx in morph_indices[~in_database].tolist():
+        print_log_report("WARNING","Index {0} not in bounding box database".format(idx))
+
+    scales = numpy.ones((len(morph_indices), 3))
+    scales[in_database] = scale_factors[rows[in_database]]
+    #The deltas of the vertices with invalid box are removed
+    valid = ~numpy.isnan(scales).any(axis=1)
     print_log_report("INFO","Morphing corrected in {0} secs".format(time.time()-time1))
-    return new_morph_deltas
+    return (numpy.ascontiguousarray(morph_indices[valid], dtype=numpy.int32),
+            (morph_deltas[valid]*scales[valid]).astype(numpy.float32))
 
 def check_version(m_vers, min_version = (1,5,0)):
 
@@ -468,20 +510,105 @@ def is_in_list(list1,list2,position="ANY"):
                     return True
     return False
 
-def load_json_data(json_path, description=None):
+#Parsed json databases are stored in the cache folder with marshal.
+#Each file stores the signature of the source json together with
+#the Python version, because the marshal format is not portable.
+JSON_CACHE_EXTENSION = ".mbjson"
+JSON_CACHE_VERSION = 1
+json_cache_stats = {"hits":0, "misses":0}
+json_cache_lock = threading.Lock()
+
+def get_json_cache_stats():
+    with json_cache_lock:
+        return dict(json_cache_stats)
+
+def reset_json_cache_stats():
+    with json_cache_lock:
+        json_cache_stats["hits"] = 0
+        json_cache_stats["misses"] = 0
+
+def count_json_cache_access(hit):
+    with json_cache_lock:
+        if hit:
+            json_cache_stats["hits"] += 1
+        else:
+            json_cache_stats["misses"] += 1
+
+def get_json_cache_file(json_path):
+    """
+    Return the cache file of the json database, or None if the
+    file is not part of the lab data (i.e. user files).
+    """
+    data_path = get_data_path()
+    if data_path:
+        real_path = os.path.realpath(json_path)
+        if real_path.startswith(os.path.realpath(data_path)+os.sep):
+            cache_path = get_cache_path()
+            if cache_path:
+                key = hashlib.sha1(real_path.encode("utf-8")).hexdigest()
+                return os.path.join(cache_path, key+JSON_CACHE_EXTENSION)
+    return None
+
+def get_json_signature(json_path):
+    source_stat = os.stat(json_path)
+    return (JSON_CACHE_VERSION, sys.version_info[:2], source_stat.st_size, source_stat.st_mtime)
+
+def read_json_cache(cache_file, signature):
+    """
+    Return (True, data) if the cache file is valid for the signature.
+    """
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "rb") as c_file:
+                cache_signature, j_database = marshal.loads(c_file.read())
+            if cache_signature == signature:
+                return True, j_database
+        except (OSError, EOFError, ValueError, TypeError):
+            print_log_report("WARNING","Corrupted cache file: {0}".format(simple_path(cache_file)))
+    return False, None
+
+def write_json_cache(cache_file, signature, j_database):
+    temp_path = "{0}.{1}.tmp".format(cache_file, os.getpid())
+    try:
+        with open(temp_path, "wb") as c_file:
+            marshal.dump((signature, j_database), c_file)
+        os.replace(temp_path, cache_file)
+    except (OSError, ValueError):
+        print_log_report("WARNING","Cannot write the cache file {0}".format(simple_path(cache_file)))
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+def load_json_data(json_path, description=None, use_cache=True):
+    """
+    Load the json file, using its marshal cache if the file is part
+    of the lab data. The loaders that compile the data in their own
+    format pass use_cache=False, so no marshal copy is written.
+    """
     if os.path.isfile(json_path):
         time1 = time.time()
-        j_file = open(json_path, "r")
+        cache_file = None
+        if use_cache:
+            cache_file = get_json_cache_file(json_path)
+        signature = get_json_signature(json_path)
+        from_cache = False
         j_database = None
-        try:
-            j_database = json.load(j_file)
-        except:
-            print_log_report("WARNING","Errors in json file: {0}".format(simple_path(json_path)))
-        j_file.close()
+        if cache_file:
+            from_cache, j_database = read_json_cache(cache_file, signature)
+            count_json_cache_access(from_cache)
+        if not from_cache:
+            j_file = open(json_path, "r")
+            try:
+                j_database = json.load(j_file)
+            except:
+                print_log_report("WARNING","Errors in json file: {0}".format(simple_path(json_path)))
+            j_file.close()
+            if cache_file and j_database is not None:
+                write_json_cache(cache_file, signature, j_database)
+        source = "cache" if from_cache else "json"
         if not description:
-            print_log_report("INFO","Json database {0} loaded in {1} secs".format(simple_path(json_path),time.time()-time1))
+            print_log_report("INFO","Json database {0} loaded from {1} in {2} secs".format(simple_path(json_path),source,time.time()-time1))
         else:
-            print_log_report("INFO","{0} loaded from {1} in {2} secs".format(description,simple_path(json_path),time.time()-time1))
+            print_log_report("INFO","{0} loaded from {1} ({2}) in {3} secs".format(description,simple_path(json_path),source,time.time()-time1))
         return j_database
     else:
         if simple_path(json_path) != "":
@@ -1012,9 +1139,15 @@ def new_shapekey(obj, shapekey_name, slider_min = 0, slider_max = 1.0, value = 1
 
 
 def new_shapekey_from_current_vertices(obj, shapekey_name):
+    return new_shapekey_from_coords(obj, shapekey_name, get_vertices_coords(obj))
+
+
+def new_shapekey_from_coords(obj, shapekey_name, coords):
+    """
+    Create the shapekey and set its (N x 3) coordinates in one call.
+    """
     shapekey = new_shapekey(obj, shapekey_name)
-    for i in range(len(obj.data.vertices)):
-        shapekey.data[i].co = obj.data.vertices[i].co
+    shapekey.data.foreach_set("co", numpy.ascontiguousarray(coords, dtype=numpy.float32).ravel())
     return shapekey
 
 
@@ -1060,6 +1193,26 @@ def load_vertices_database(vertices_path):
             vertices.append(mathutils.Vector(vert_co))
     return vertices
 
+def get_vertices_coords(obj, coords=None):
+    """
+    Read all the vertex coordinates of the mesh
+    with a single call, as a (N x 3) float32 array.
+    If coords is given, it is filled in place.
+    """
+    vertices = obj.data.vertices
+    if coords is None:
+        coords = numpy.empty((len(vertices), 3), dtype=numpy.float32)
+    vertices.foreach_get("co", coords.reshape(-1))
+    return coords
+
+def set_vertices_coords(obj, coords):
+    """
+    Write all the vertex coordinates of the mesh
+    with a single call from a (N x 3) float32 array.
+    """
+    obj.data.vertices.foreach_set("co", numpy.ascontiguousarray(coords, dtype=numpy.float32).ravel())
+    obj.data.update()
+
 def set_verts_coords_from_file(obj,vertices_path):
     new_vertices = load_vertices_database(vertices_path)
     if obj:
@@ -1315,6 +1468,38 @@ def remove_vertgroup(obj, group_name):
 def new_vertgroup(obj, group_name):
     return obj.vertex_groups.new(name=group_name)
 
+def set_vertgroups_weights(obj, vertgroups_weights, weight_decimals=3):
+    """
+    Assign the weights to the vertex groups. vertgroups_weights is a
+    list of (vertgroup, indices, weights), with indices and weights as
+    arrays. If the mesh has no shape keys and the object is in object
+    mode, all the weights are written in the deform layer of a bmesh,
+    with one transfer to the mesh. Otherwise the weights are rounded
+    to weight_decimals, so the vertices of each group fall in few
+    buckets, each one added with a single call.
+    """
+    mesh = obj.data
+    if mesh.shape_keys is None and obj.mode == 'OBJECT':
+        b_mesh = bmesh.new()
+        b_mesh.from_mesh(mesh)
+        deform_layer = b_mesh.verts.layers.deform.verify()
+        b_mesh.verts.ensure_lookup_table()
+        b_verts = b_mesh.verts
+        for vertgroup, indices, weights in vertgroups_weights:
+            group_index = vertgroup.index
+            for idx, weight in zip(indices.tolist(), weights.tolist()):
+                b_verts[idx][deform_layer][group_index] = weight
+        b_mesh.to_mesh(mesh)
+        b_mesh.free()
+        mesh.update()
+    else:
+        for vertgroup, indices, weights in vertgroups_weights:
+            bucket_weights, buckets = numpy.unique(numpy.round(weights, weight_decimals), return_inverse=True)
+            order = numpy.argsort(buckets, kind="stable")
+            bucket_starts = numpy.searchsorted(buckets[order], numpy.arange(len(bucket_weights)))
+            for bucket_indices, weight in zip(numpy.split(indices[order], bucket_starts[1:]), bucket_weights.tolist()):
+                vertgroup.add(bucket_indices.tolist(), weight, 'REPLACE')
+
 def play_animation():
     if not bpy.context.screen.is_animation_playing:
         bpy.ops.screen.animation_play()
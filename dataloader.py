@@ -0,0 +1,178 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2018 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import threading
+import concurrent.futures
+from . import algorithms
+
+#The functions submitted to the loader must not touch bpy:
+#the data they return is consumed later, on the main thread.
+
+
+class DatabaseLoader:
+    """
+    Load the databases of a session in a pool of threads.
+    Each request is identified by a key (usually the file path)
+    and belongs to a stage, used to report the timings.
+    """
+
+    def __init__(self, max_workers=6):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="mblab_loader")
+        self.futures = {}
+        self.stages = {}
+        self.timings = {}
+        self.timings_lock = threading.Lock()
+        self.time_start = time.time()
+
+    def __repr__(self):
+        return "DatabaseLoader with {0} requests ({1} pending)".format(
+            len(self.futures),
+            len(self.futures)-len(self.timings))
+
+    def run_request(self, key, func, args):
+        time1 = time.time()
+        try:
+            return func(*args)
+        finally:
+            with self.timings_lock:
+                self.timings[key] = (time1-self.time_start, time.time()-time1)
+
+    def submit(self, stage, key, func, *args):
+        #The shared databases already in memory are not loaded again
+        if key not in self.futures and key not in database_registry:
+            self.stages[key] = stage
+            self.futures[key] = self.executor.submit(self.run_request, key, func, args)
+
+    def get(self, key, func, *args):
+        """
+        Return the result of the request. If the key was never
+        submitted, the function is called in the current thread.
+        """
+        if key in self.futures:
+            try:
+                return self.futures[key].result()
+            except Exception as e:
+                algorithms.print_log_report("ERROR","Background loading of {0} failed: {1}".format(algorithms.simple_path(key),e))
+        return func(*args)
+
+    def is_done(self):
+        for future in self.futures.values():
+            if not future.done():
+                return False
+        return True
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def report_timings(self):
+        """
+        Log the time of each request and the total of each stage.
+        The longest stage is the critical path of the loading.
+        """
+        stage_times = {}
+        with self.timings_lock:
+            timings = dict(self.timings)
+        for key in sorted(timings, key=lambda k: timings[k][0]):
+            start, duration = timings[key]
+            stage = self.stages[key]
+            stage_end = max(stage_times.get(stage, 0.0), start+duration)
+            stage_times[stage] = stage_end
+            algorithms.print_log_report("INFO","Stage {0}: {1} started at {2:.3f} secs, loaded in {3:.3f} secs".format(
+                stage, algorithms.simple_path(key), start, duration))
+        for stage in sorted(stage_times, key=stage_times.get):
+            algorithms.print_log_report("INFO","Stage {0} completed at {1:.3f} secs".format(stage, stage_times[stage]))
+        if stage_times:
+            critical_stage = max(stage_times, key=stage_times.get)
+            algorithms.print_log_report("INFO","Critical path: stage {0}, {1:.3f} secs".format(
+                critical_stage, stage_times[critical_stage]))
+        return stage_times
+
+
+class DatabaseRegistry:
+    """
+    Process-wide collection of the read-only databases, shared by
+    all the characters of the scene. Each database is keyed by its
+    file and removed when the last engine releases it.
+    """
+
+    def __init__(self):
+        self.databases = {}
+        self.ref_counts = {}
+        self.registry_lock = threading.RLock()
+
+    def __contains__(self, key):
+        return os.path.realpath(key) in self.databases
+
+    def __repr__(self):
+        return "DatabaseRegistry with {0} databases".format(len(self.databases))
+
+    def acquire(self, key, func, *args):
+        """
+        Return the database of the key, loading it with func(*args)
+        if no engine is using it. Each acquire must be paired with a
+        release. If the loading fails, None is returned and the
+        key is not registered.
+        """
+        real_key = os.path.realpath(key)
+        with self.registry_lock:
+            if real_key in self.databases:
+                self.ref_counts[real_key] += 1
+                return self.databases[real_key]
+            database = func(*args)
+            if database is not None:
+                self.databases[real_key] = database
+                self.ref_counts[real_key] = 1
+            return database
+
+    def release(self, key):
+        real_key = os.path.realpath(key)
+        with self.registry_lock:
+            if real_key in self.ref_counts:
+                self.ref_counts[real_key] -= 1
+                if self.ref_counts[real_key] <= 0:
+                    del self.ref_counts[real_key]
+                    del self.databases[real_key]
+                    algorithms.print_log_report("INFO","Database {0} released".format(algorithms.simple_path(key)))
+
+
+database_registry = DatabaseRegistry()
+
+
+def get_data(data_loader, key, func, *args):
+    """
+    Return the result of func(*args), using the loader if available.
+    """
+    if data_loader:
+        return data_loader.get(key, func, *args)
+    return func(*args)
+
+
+def read_file(filepath, chunk_size=1048576):
+    """
+    Read the file to move it in the OS page cache, so the
+    following read from the main thread is not bound by the disk.
+    """
+    n_bytes = 0
+    if os.path.isfile(filepath):
+        with open(filepath, "rb") as data_file:
+            chunk = data_file.read(chunk_size)
+            while chunk:
+                n_bytes += len(chunk)
+                chunk = data_file.read(chunk_size)
+    return n_bytes
@@ -1,4 +1,3 @@
-import json
 import os
 import bpy
 import traceback
@@ -198,9 +197,8 @@ def setup_face_rig():
         algorithms.print_log_report("CRITICAL", "{0} not found. Might need to reinstall ManuelBastioniLab".format(json_file))
         return False
 
-    with open(json_file, 'r') as f:
-        drivers = json.load(f)
-        add_drivers(drivers)
+    drivers = algorithms.load_json_data(json_file, "Face rig drivers")
+    add_drivers(drivers)
 
     return True
 
@@ -227,14 +225,13 @@ def setup_facs_rig():
         algorithms.print_log_report("CRITICAL", "{0} not found. Might need to reinstall ManuelBastioniLab".format(json_file))
         return False
 
-    with open(json_file, 'r') as f:
-        shape_keys = json.load(f)
-        try:
-            add_facs_drivers(shape_keys)
-        except Exception as e:
-            traceback.print_stack()
-            algorithms.print_log_report("CRITICAL", "{0}".format(str(e)))
-            return False
+    shape_keys = algorithms.load_json_data(json_file, "FACS drivers")
+    try:
+        add_facs_drivers(shape_keys)
+    except Exception as e:
+        traceback.print_stack()
+        algorithms.print_log_report("CRITICAL", "{0}".format(str(e)))
+        return False
 
     return True
 
@@ -14,11 +14,23 @@
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import bpy
-from . import morphengine, skeletonengine, algorithms, proxyengine, materialengine
+from . import morphengine, skeletonengine, algorithms, proxyengine, materialengine, dataloader
 import os
 import time
 import json
 import operator
+import numpy
+
+
+#Keywords used by the random generator to classify the properties
+GENERATION_KEYS = {
+    "Face": ["Eye", "Eyelid", "Nose", "Mouth", "Ear", "Head", "Forehead", "Cheek", "Jaw"],
+    "Body": ["Armpit", "Elbows", "Chest", "Body", "Arms", "Feet", "Wrists", "Waist", "Torso","Stomach","Shoulders","Pelvis","Neck","Legs","Hands"],
+    "Height": ["Length", "Body_Size"],
+    "Mass": ["Mass"],
+    "Tone": ["Tone"],
+    "Fantasy": ["Fantasy"],
+    "Expressions": ["Expressions"]}
 
 
 class HumanModifier:
@@ -142,6 +154,126 @@ class HumanCategory:
             len(self.modifiers))
 
 
+class CharacterData:
+    """
+    The values of the character properties, stored in a float array.
+    The properties are added while the database is initialized; after
+    freeze() the table of the names can't change. Groups of properties
+    (categories, modifiers) are kept as arrays of indices, so the bulk
+    operations work on slices of the array. For the existing code it
+    behaves like a dictionary.
+    """
+
+    def __init__(self, default_value=0.5):
+        self.default_value = default_value
+        self.names = []
+        self.indices = {}
+        self.groups = {}
+        self.values = numpy.zeros(0, dtype=numpy.float64)
+        self.is_frozen = False
+
+    def add(self, prop):
+        if prop not in self.indices:
+            if self.is_frozen:
+                raise KeyError("Property {0} can't be added to frozen character data".format(prop))
+            self.indices[prop] = len(self.names)
+            self.names.append(prop)
+            self.values = numpy.append(self.values, self.default_value)
+
+    def freeze(self):
+        self.names = tuple(self.names)
+        self.is_frozen = True
+
+    def __getitem__(self, prop):
+        return float(self.values[self.indices[prop]])
+
+    def __setitem__(self, prop, value):
+        if prop not in self.indices:
+            self.add(prop)
+        self.values[self.indices[prop]] = value
+
+    def __contains__(self, prop):
+        return prop in self.indices
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def items(self):
+        return zip(self.names, self.values.tolist())
+
+    def get(self, prop, default=None):
+        if prop in self.indices:
+            return self[prop]
+        return default
+
+    def copy(self):
+        data_copy = CharacterData(self.default_value)
+        data_copy.names = self.names
+        data_copy.indices = self.indices
+        data_copy.groups = self.groups
+        data_copy.values = self.values.copy()
+        data_copy.is_frozen = self.is_frozen
+        return data_copy
+
+    def get_indices(self, props):
+        return numpy.array([self.indices[prop] for prop in props], dtype=numpy.int64)
+
+    def add_group(self, name, props):
+        self.groups[name] = self.get_indices(props)
+
+    def get_group(self, name):
+        return self.groups[name]
+
+    def reset(self, indices=slice(None)):
+        self.values[indices] = self.default_value
+
+    def get_changed_values(self, roundness=None):
+        """
+        Return a dictionary with the properties that are
+        not at the default value.
+        """
+        changed = numpy.flatnonzero(self.values != self.default_value)
+        values = self.values[changed]
+        if roundness is not None:
+            values = numpy.round(values, roundness)
+        return {self.names[idx]: value for idx, value in zip(changed.tolist(), values.tolist())}
+
+    def load_values(self, values_dict, reset_string=None, reset_unassigned=True, mix=False):
+        """
+        Set the properties from a dictionary of values. The properties
+        containing reset_string are reset first. The unassigned ones
+        are reset too, if reset_unassigned is True. If mix is True, the
+        new values are averaged with the current ones.
+        """
+        if reset_string is not None:
+            reset_mask = numpy.array([reset_string in prop for prop in self.names], dtype=bool)
+            self.values[reset_mask] = self.default_value
+
+        new_values = numpy.full(len(self.names), self.default_value)
+        assigned = numpy.zeros(len(self.names), dtype=bool)
+        for prop, value in values_dict.items():
+            if prop in self.indices:
+                idx = self.indices[prop]
+                new_values[idx] = value
+                assigned[idx] = True
+        if mix:
+            new_values = (self.values+new_values)/2
+        if not reset_unassigned:
+            new_values[~assigned] = self.values[~assigned]
+        self.values[:] = new_values
+
+    def __repr__(self):
+        return "CharacterData with {0} properties, {1} changed".format(
+            len(self.names),
+            numpy.count_nonzero(self.values != self.default_value))
+
+
 class Humanoid:
     """
     The humanoid is a container for categories of modifiers.
@@ -152,6 +284,8 @@ class Humanoid:
         self.lab_vers = list(lab_version)
         self.has_data = False
         self.obj_name = ""
+        self.morph_engine = None
+        self.random_generator = numpy.random.RandomState()
         self.data_path = algorithms.get_data_path()
         self.characters_config = algorithms.get_configuration()
         self.lib_filepath = algorithms.get_blendlibrary_path()
@@ -180,7 +314,21 @@ class Humanoid:
         return item_list
 
 
-    def init_database(self,obj,character_identifier,rigging_type):
+    def preload_databases(self,character_identifier,rigging_type):
+        """
+        Start the loading of the character databases in background
+        and return the loader to pass to init_database.
+        """
+        character_config = self.characters_config[character_identifier]
+        #The cache statistics logged by init_database are per session
+        algorithms.reset_json_cache_stats()
+        data_loader = dataloader.DatabaseLoader()
+        morphengine.preload_databases(data_loader, character_config)
+        skeletonengine.preload_databases(data_loader, character_config, rigging_type)
+        materialengine.preload_databases(data_loader, character_config)
+        return data_loader
+
+    def init_database(self,obj,character_identifier,rigging_type,data_loader=None):
         scn = bpy.context.scene
 
         self.has_data = False
@@ -192,12 +340,13 @@ class Humanoid:
         self.no_categories = "BasisAsymTest"
         self.categories = {}
         self.bodydata_realtime_activated = True
-        self.sk_engine = skeletonengine.SkeletonEngine(obj,self.characters_config[character_identifier],rigging_type)
+        self.sk_engine = skeletonengine.SkeletonEngine(obj,self.characters_config[character_identifier],rigging_type,data_loader)
 
         self.character_template_name = self.characters_config[character_identifier]["template_model"]
         self.transformation_filename = self.characters_config[character_identifier]["transformations_file"]
         self.phenotype_data_folder = self.characters_config[character_identifier]["name"]+"_ptypes"
         self.presets_data_folder = self.characters_config[character_identifier]["presets_folder"]
+        self.delta_measures_filename = self.characters_config[character_identifier]["name"]+"_delta_measures.json"
 
         self.phenotypes_path = os.path.join(self.data_path, "phenotypes",self.phenotype_data_folder)
         self.presets_path = os.path.join(self.data_path, "presets",self.presets_data_folder)
@@ -211,9 +360,14 @@ class Humanoid:
         self.exists_transform_data = os.path.isfile(self.transformations_data_path)
 
         self.corrective_modifier_name = "mbastlab_corrective_modifier"
-        self.morph_engine = morphengine.MorphingEngine(self.obj_name, self.characters_config[character_identifier])
-        self.mat_engine = materialengine.MaterialEngine(self.obj_name, self.characters_config[character_identifier])
-        self.character_data = {}
+        #The databases still used by the previous engine are
+        #released only after the new engine has acquired them
+        previous_morph_engine = self.morph_engine
+        self.morph_engine = morphengine.MorphingEngine(self.obj_name, self.characters_config[character_identifier], data_loader)
+        self.mat_engine = materialengine.MaterialEngine(self.obj_name, self.characters_config[character_identifier], data_loader)
+        if previous_morph_engine:
+            previous_morph_engine.release_databases()
+        self.character_data = CharacterData()
         self.character_metaproperties = {"last_character_age":0.0,
                                         "character_age":0.0,
                                         "last_character_mass":0.0,
@@ -225,9 +379,12 @@ class Humanoid:
         self.metadata_realtime_activated = True
         self.material_realtime_activated = True
         self.transformations_data = {}
+        self.transformations_vectors = {}
+        self.generation_masks = {}
 
-        for morph in self.morph_engine.morph_data.keys():
+        for morph in self.morph_engine.get_morph_names():
             self.init_character_data(morph)
+        self.init_character_data_groups()
 
         algorithms.print_log_report("INFO","Loaded {0} categories from morph database".format(
             len(self.categories)))
@@ -239,6 +396,9 @@ class Humanoid:
         self.add_corrective_smooth_modifier()
         self.add_subdivision_modifier()
         self.add_displacement_modifier()
+        cache_stats = algorithms.get_json_cache_stats()
+        algorithms.print_log_report("INFO","Json cache of the session: {0} hits, {1} misses".format(
+            cache_stats["hits"], cache_stats["misses"]))
         self.has_data = True
 
     def add_subdivision_modifier(self):
@@ -281,6 +441,46 @@ class Humanoid:
 
     def load_transformation_database(self):
         self.transformations_data = algorithms.load_json_data(self.transformations_data_path, "Transformations database")
+        self.compile_transformations()
+
+    def compile_transformations(self):
+        """
+        Convert each transformation in a sparse vector of deltas:
+        the indices of the properties involved, their coefficients
+        for the negative and the positive values of the factor, and
+        the modifiers to recombine when the factor changes.
+        """
+        self.transformations_vectors = {}
+        if not self.transformations_data:
+            return
+        for transformation_id, tr_data in self.transformations_data.items():
+            tr_props = []
+            tr_coefficients = []
+            for prop in self.character_data:
+                coefficient_1 = 0.0
+                coefficient_2 = 0.0
+                is_involved = False
+                for tr_parameter in tr_data:
+                    if tr_parameter[0] in prop:
+                        coefficient_1 += tr_parameter[1]
+                        coefficient_2 += tr_parameter[2]
+                        is_involved = True
+                if is_involved:
+                    tr_props.append(prop)
+                    tr_coefficients.append([coefficient_1, coefficient_2])
+
+            tr_props_set = set(tr_props)
+            tr_modifiers = []
+            for category in self.get_categories():
+                for modifier in category.get_modifiers():
+                    if tr_props_set.intersection(modifier.properties):
+                        tr_modifiers.append(modifier)
+
+            self.transformations_vectors[transformation_id] = (
+                self.character_data.get_indices(tr_props),
+                numpy.array(tr_coefficients, dtype=numpy.float64).reshape(-1, 2),
+                tr_modifiers)
+        algorithms.print_log_report("INFO","Compiled {0} transformations".format(len(self.transformations_vectors)))
 
     def get_categories(self):
         categories = self.categories.values()
@@ -317,16 +517,38 @@ class Humanoid:
                     prop = components[0]+"_" + element
                     if prop not in modifier:
                         modifier.add(prop)
-                    self.character_data[prop] = 0.5
+                    self.character_data.add(prop)
             else:
                 algorithms.print_log_report("WARNING","Wrong name for morph: {0}".format(morph_name))
 
+    def init_character_data_groups(self):
+        """
+        Freeze the properties table and index the
+        properties of each category and modifier.
+        """
+        self.character_data.freeze()
+        for category in self.get_categories():
+            self.character_data.add_group(category.name, category.get_all_properties())
+            for modifier in category.get_modifiers():
+                self.character_data.add_group(modifier.name, modifier.get_properties())
+        self.init_generation_masks()
+
+    def init_generation_masks(self):
+        """
+        Classify the properties for the random generator. Each mask
+        marks the properties that a preserve option leaves unchanged.
+        """
+        self.generation_masks = {}
+        for group_name, group_keys in GENERATION_KEYS.items():
+            self.generation_masks[group_name] = numpy.array(
+                [any(k in prop for k in group_keys) for prop in self.character_data],
+                dtype=bool)
+
     def reset_category(self, categ):
         time1 = time.time()
         obj = self.get_object()
         category = self.get_category(categ)
-        for prop in category.get_all_properties():
-            self.character_data[prop] = 0.5
+        self.character_data.reset(self.character_data.get_group(category.name))
         self.update_character(category_name=category.name, mode = "update_all")
         algorithms.print_log_report("INFO","Category resetted in {0} secs".format(time.time()-time1))
 
@@ -356,7 +578,7 @@ class Humanoid:
         return self.exists_transform_data
 
 
-    def automodelling(self,use_measures_from_GUI=False, use_measures_from_dict=None, use_measures_from_current_obj=False, mix=False):
+    def automodelling(self,use_measures_from_GUI=False, use_measures_from_dict=None, use_measures_from_current_obj=False, mix=False, least_squares=False):
 
         if self.morph_engine.measures_database_exist:
             time2 = time.time()
@@ -383,16 +605,14 @@ class Humanoid:
                 wished_measures["body_height_Z"] = total_height_Z
 
             if use_measures_from_current_obj:
-                current_shape_verts = []
-                for vert in obj.data.vertices:
-                    current_shape_verts.append(vert.co.copy())
+                current_shape_verts = algorithms.get_vertices_coords(obj)
                 wished_measures = self.morph_engine.calculate_measures(vert_coords=current_shape_verts)
 
             if use_measures_from_dict:
                 wished_measures = use_measures_from_dict
 
             self.morph_engine.calculate_proportions(wished_measures)
-            similar_characters_data  = self.morph_engine.compare_data_proportions()
+            similar_characters_data  = self.morph_engine.compare_data_proportions(n_samples)
 
             best_character = similar_characters_data[0]
             filepath = best_character[1]
@@ -402,14 +622,17 @@ class Humanoid:
                     filepath = char_data[1]
                     self.load_character(filepath, mix = True)
 
-            self.measure_fitting(wished_measures, mix)
+            if least_squares:
+                self.measure_fitting_least_squares(wished_measures, mix)
+            else:
+                self.measure_fitting(wished_measures, mix)
             self.update_character(mode = "update_directly_verts")
             algorithms.select_and_change_mode(obj,'OBJECT')
 
             algorithms.print_log_report("INFO","Human fitting in {0} secs".format(time.time()-time2))
 
     def clean_verts_to_process(self):
-        self.morph_engine.verts_to_update.clear()
+        self.morph_engine.clean_verts_to_update()
 
     def update_displacement(self):
         obj = self.get_object()
@@ -532,10 +755,7 @@ class Humanoid:
         time1 = time.time()
         obj = self.get_object()
         self.reset_metadata()
-        for category in self.get_categories():
-            for modifier in category.get_modifiers():
-                for prop in modifier.get_properties():
-                    self.character_data[prop] = 0.5
+        self.character_data.reset()
         self.update_character(mode = "update_all")
 
 
@@ -656,11 +876,23 @@ class Humanoid:
             if hasattr(obj, measure_name):
                 setattr(obj, measure_name, measure_val*conversion_factor)
 
+    def finish_realtime_update(self):
+        """
+        Complete the updates deferred while the sliders move,
+        once the morphs are applied to the mesh.
+        """
+        time1 = time.time()
+        obj = self.get_object()
+        self.sk_engine.fit_joints(self.morph_engine.final_form)
+        obj.data.calc_normals()
+        self.sync_gui_according_measures()
+        algorithms.print_log_report("DEBUG","Realtime update completed in {0} secs".format(time.time()-time1))
+
     def update_bendy_muscles(self):
         armat = self.get_armature()
         algorithms.update_bendy_bones(armat)
 
-    def update_character(self, category_name = None, mode = "update_all"):
+    def update_character(self, category_name = None, mode = "update_all", modifiers = None):
         time1 = time.time()
         obj = self.get_object()
         self.clean_verts_to_process()
@@ -695,6 +927,19 @@ class Humanoid:
             sync_GUI_metadata = False
             sync_GUI_materials = False
 
+        if mode == "update_transformation":
+            update_directly_verts = False
+            update_geometry_all = False
+            update_geometry_selective = True
+            update_armature = True
+            update_normals = True
+            update_proxy = False
+            update_measures = True
+            sync_morphdata = False
+            sync_GUI = True
+            sync_GUI_metadata = False
+            sync_GUI_materials = False
+
         if mode == "update_directly_verts":
             update_directly_verts = True
             update_geometry_all = False
@@ -734,6 +979,19 @@ class Humanoid:
             sync_GUI_metadata = False
             sync_GUI_materials = False
 
+        if mode == "update_realtime_morphs":
+            update_directly_verts = False
+            update_geometry_all = False
+            update_geometry_selective = True
+            update_armature = False
+            update_normals = False
+            update_proxy = False
+            update_measures = False
+            sync_morphdata = True
+            sync_GUI = False
+            sync_GUI_metadata = False
+            sync_GUI_materials = False
+
 
         if update_directly_verts:
             self.morph_engine.update(update_all_verts=True)
@@ -748,10 +1006,12 @@ class Humanoid:
                     if sync_morphdata:
                         modifier.sync_modifier_data_to_obj_prop(self.character_data)
                     self.combine_morphings(modifier)
+            elif modifiers is not None:
+                #Only the modifiers involved in the change are recombined
+                for modifier in modifiers:
+                    self.combine_morphings(modifier)
             else:
-                for category in self.get_categories():
-                    for modifier in category.get_modifiers():
-                        self.combine_morphings(modifier, add_vertices_to_update=True)
+                self.combine_all_morphings()
 
         if update_geometry_all:
             self.morph_engine.update(update_all_verts=True)
@@ -768,7 +1028,9 @@ class Humanoid:
         if update_measures:
             self.sync_gui_according_measures()
         if update_armature:
-            self.sk_engine.fit_joints()
+            #A full update refits all the bones, also if the
+            #armature was changed outside the lab
+            self.sk_engine.fit_joints(self.morph_engine.final_form, force = mode == "update_all")
         if update_normals:
             obj.data.calc_normals()
         if update_proxy:
@@ -778,68 +1040,35 @@ class Humanoid:
 
         #algorithms.print_log_report("DEBUG","Character updated in {0} secs".format(time.time()-time1))
 
-    def generate_character(self,random_value,prv_face,prv_body,prv_mass,prv_tone,prv_height,prv_phenotype,set_tone_and_mass,body_mass,body_tone,prv_fantasy):
+    def generate_character(self,random_value,prv_face,prv_body,prv_mass,prv_tone,prv_height,prv_phenotype,set_tone_and_mass,body_mass,body_tone,prv_fantasy,seed=None):
         algorithms.print_log_report("INFO","Generating character...")
 
-        all_props = [x for x in self.character_data.keys()]
-        props_to_process = all_props.copy()
-
-        face_keys = ["Eye", "Eyelid", "Nose", "Mouth", "Ear", "Head", "Forehead", "Cheek", "Jaw"]
-        body_keys = ["Armpit", "Elbows", "Chest", "Body", "Arms", "Feet", "Wrists", "Waist", "Torso","Stomach","Shoulders","Pelvis","Neck","Legs","Hands"]
-        height_keys = ["Length", "Body_Size"]
-        mass_keys = ["Mass"]
-        tone_keys = ["Tone"]
-        expression_keys = ["Expressions"]
-
-        for prop in all_props:
-            remove_it = False
-            for k in expression_keys:
-                if k in prop:
-                    remove_it = True
-                    break
-            if prv_face:
-                for k in face_keys:
-                    if k in prop:
-                        remove_it = True
-                        break
-            if prv_fantasy:
-                if "Fantasy" in prop:
-                    remove_it = True
-            if prv_body:
-                for k in body_keys:
-                    if k in prop:
-                        remove_it = True
-                        break
-            if prv_mass:
-                for k in mass_keys:
-                    if k in prop:
-                        remove_it = True
-                        break
-            if prv_tone:
-                for k in tone_keys:
-                    if k in prop:
-                        remove_it = True
-                        break
-            if prv_height:
-                for k in height_keys:
-                    if k in prop:
-                        remove_it = True
-                        break
-            if remove_it:
-                if prop in props_to_process:
-                    props_to_process.remove(prop)
-
-        for prop in props_to_process:
-            new_val = algorithms.generate_parameter(
-                self.character_data[prop],
-                random_value,
-                prv_phenotype)
-            if set_tone_and_mass:
-                if "Mass" in prop:
-                    new_val = body_mass
-                if "Tone" in prop:
-                    new_val = body_tone
-            self.character_data[prop] = new_val
+        if seed is not None:
+            self.random_generator.seed(seed)
+
+        keep_mask = self.generation_masks["Expressions"].copy()
+        preserved_groups = [
+            (prv_face, "Face"),
+            (prv_fantasy, "Fantasy"),
+            (prv_body, "Body"),
+            (prv_mass, "Mass"),
+            (prv_tone, "Tone"),
+            (prv_height, "Height")]
+        for is_preserved, group_name in preserved_groups:
+            if is_preserved:
+                keep_mask |= self.generation_masks[group_name]
+        process_mask = ~keep_mask
+
+        values = self.character_data.values
+        new_values = algorithms.generate_parameters(
+            values[process_mask],
+            random_value,
+            prv_phenotype,
+            self.random_generator)
+        if set_tone_and_mass:
+            new_values[self.generation_masks["Mass"][process_mask]] = body_mass
+            new_values[self.generation_masks["Tone"][process_mask]] = body_tone
+        values[process_mask] = new_values
         self.update_character(mode = "update_all")
 
 
@@ -879,15 +1108,13 @@ class Humanoid:
             last_transformation_1 = -previous_tr_factor
 
 
-        if transformation_id in self.transformations_data:
-            tr_data = self.transformations_data[transformation_id]
-
-            for prop in self.character_data:
-                for tr_parameter in tr_data:
-                    if tr_parameter[0] in prop:
-                        linear_factor = tr_parameter[1]*transformation_1 + tr_parameter[2]*transformation_2 - tr_parameter[1]*last_transformation_1 - tr_parameter[2]*last_transformation_2
+        if transformation_id in self.transformations_vectors:
+            tr_indices, tr_coefficients, tr_modifiers = self.transformations_vectors[transformation_id]
 
-                        self.character_data[prop] = self.character_data[prop] + linear_factor
+            factors_delta = numpy.array([
+                transformation_1 - last_transformation_1,
+                transformation_2 - last_transformation_2])
+            self.character_data.values[tr_indices] += tr_coefficients @ factors_delta
 
             if tr_type == "AGE":
                 self.character_metaproperties['character_age'] = current_tr_factor
@@ -899,46 +1126,88 @@ class Humanoid:
                 self.character_metaproperties['character_tone'] = current_tr_factor
                 self.character_metaproperties['last_character_tone'] = current_tr_factor
 
-            self.update_character(mode = "update_metadata")
+            self.update_character(mode = "update_transformation", modifiers = tr_modifiers)
 
         else:
             algorithms.print_log_report("WARNING","{0} data not present".format(transformation_id))
 
 
     def init_delta_measures(self):
-
-        obj = self.get_object()
+        """
+        Calculate, for each property related to a measure, the
+        variation of the measure when the property goes from 0.5
+        to 0 and to 1. The morphs are applied to a copy of the base
+        form, so the mesh is not changed, and the result is cached
+        for the character type.
+        """
         time1 = time.time()
-        for relation in self.morph_engine.measures_relat_data:
-            m_name = relation[0]
-            modifier_name = relation[1]
-            for category in self.get_categories():
-                for modifier in category.get_modifiers():
-                    if modifier.name == modifier_name:
-                        for prop in modifier.get_properties():
-
-                            self.character_data[prop] = 0.0
-                            self.combine_morphings(modifier)
-                            measure1 = self.morph_engine.calculate_measures(measure_name=m_name)
+        signature = self.morph_engine.get_databases_signature()
+        self.delta_measures = self.load_delta_measures_cache(signature)
+        if self.delta_measures is None:
+            self.delta_measures = {}
+            for relation in self.morph_engine.measures_relat_data:
+                m_name = relation[0]
+                modifier_name = relation[1]
+                for category in self.get_categories():
+                    for modifier in category.get_modifiers():
+                        if modifier.name == modifier_name:
+                            for prop in modifier.get_properties():
+                                measure1 = self.calculate_modifier_measure(m_name, modifier, prop, 0.0)
+                                measure3 = self.calculate_modifier_measure(m_name, modifier, prop, 1.0)
+                                measure2 = self.calculate_modifier_measure(m_name, modifier, prop, 0.5)
 
-                            self.character_data[prop] = 1.0
-                            self.combine_morphings(modifier)
-                            measure3 = self.morph_engine.calculate_measures(measure_name=m_name)
+                                delta_name = modifier_name+prop
 
-                            #Last measure also restores the value to 0.5
-                            self.character_data[prop] = 0.5
-                            self.combine_morphings(modifier)
-                            measure2 = self.morph_engine.calculate_measures(measure_name=m_name)
+                                delta1 = measure1-measure2
+                                delta3 = measure3-measure2
 
-                            delta_name = modifier_name+prop
+                                self.delta_measures[delta_name] = [delta1,delta3]
+            self.save_delta_measures_cache(signature)
 
-                            delta1 = measure1-measure2
-                            delta3 = measure3-measure2
+        algorithms.print_log_report("INFO","Delta init in {0} secs".format(time.time()-time1))
 
-                            self.delta_measures[delta_name] = [delta1,delta3]
+    def calculate_modifier_measure(self, m_name, modifier, prop, value):
+        """
+        Return the measure of the base form when the property of the
+        modifier is set to value and the other ones are neutral.
+        """
+        modifier_data = {}
+        for modifier_prop in modifier.properties:
+            modifier_data[modifier_prop] = 0.5
+        modifier_data[prop] = value
+        names, weights = self.get_modifier_morph_values(modifier, modifier_data)
+        return self.morph_engine.calculate_morphed_measure(m_name, dict(zip(names, weights)))
+
+    def get_delta_measures_cache_file(self):
+        cache_path = algorithms.get_cache_path()
+        if cache_path:
+            return os.path.join(cache_path, self.delta_measures_filename)
+        return None
 
+    def load_delta_measures_cache(self, signature):
+        cache_file = self.get_delta_measures_cache_file()
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, "r") as c_file:
+                    cache_data = json.load(c_file)
+                if cache_data["signature"] == signature:
+                    return cache_data["delta_measures"]
+            except (OSError, ValueError, KeyError):
+                algorithms.print_log_report("WARNING","Corrupted delta measures cache {0}".format(algorithms.simple_path(cache_file)))
+        return None
 
-        algorithms.print_log_report("INFO","Delta init in {0} secs".format(time.time()-time1))
+    def save_delta_measures_cache(self, signature):
+        cache_file = self.get_delta_measures_cache_file()
+        if cache_file:
+            temp_path = "{0}.{1}.tmp".format(cache_file, os.getpid())
+            try:
+                with open(temp_path, "w") as c_file:
+                    json.dump({"signature":signature, "delta_measures":self.delta_measures}, c_file)
+                os.replace(temp_path, cache_file)
+            except OSError:
+                algorithms.print_log_report("WARNING","Cannot write the delta measures cache {0}".format(algorithms.simple_path(cache_file)))
+                if os.path.isfile(temp_path):
+                    os.remove(temp_path)
 
 
     def search_best_value(self,m_name,wished_measure,human_modifier,prop):
@@ -1004,6 +1273,77 @@ class Humanoid:
             algorithms.print_log_report("INFO","Measures fitting in {0} secs".format(time.time()-time1))
 
 
+    def measure_fitting_least_squares(self, wished_measures, mix=False):
+        """
+        Fit all the wished measures at once. Each measure is linear in
+        the related properties, with a slope below 0.5 and another one
+        above (from delta_measures), and the properties are found
+        solving one bounded least squares problem.
+        """
+        if self.morph_engine.measures_database_exist:
+            time1 = time.time()
+            measure_rows = {}
+            prop_cols = {}
+            fitting_modifiers = {}
+            relations = []
+            for relation in self.morph_engine.measures_relat_data:
+                measure_name = relation[0]
+                modifier_name = relation[1]
+                if measure_name in wished_measures:
+                    for category in self.get_categories():
+                        for modifier in category.get_modifiers():
+                            if modifier.name == modifier_name:
+                                fitting_modifiers[modifier_name] = modifier
+                                measure_rows.setdefault(measure_name, len(measure_rows))
+                                for prop in modifier.get_properties():
+                                    prop_cols.setdefault(prop, len(prop_cols))
+                                    relations.append((measure_rows[measure_name], prop_cols[prop], modifier_name+prop))
+            if not relations:
+                return
+
+            #Measures of the character with the related properties at 0.5
+            neutral_data = self.character_data.copy()
+            neutral_data.reset(neutral_data.get_indices(prop_cols))
+            neutral_values = {}
+            for modifier in fitting_modifiers.values():
+                names, weights = self.get_modifier_morph_values(modifier, neutral_data)
+                neutral_values.update(zip(names, weights))
+            neutral_measures = self.morph_engine.calculate_morphed_measures(neutral_values)
+
+            targets = numpy.zeros(len(measure_rows))
+            for measure_name, row in measure_rows.items():
+                targets[row] = wished_measures[measure_name]-neutral_measures[measure_name]
+            slopes_min = numpy.zeros((len(measure_rows), len(prop_cols)))
+            slopes_max = numpy.zeros((len(measure_rows), len(prop_cols)))
+            for row, col, delta_name in relations:
+                delta1, delta3 = self.delta_measures[delta_name]
+                slopes_min[row, col] = -2*delta1
+                slopes_max[row, col] = 2*delta3
+
+            #The variables are the offsets from 0.5. The slope of each
+            #property depends on the side of 0.5 of its solution
+            jacobian = (slopes_min+slopes_max)/2
+            for iteration in range(len(prop_cols)+1):
+                offsets = algorithms.bounded_least_squares(jacobian, targets, -0.5, 0.5)
+                new_jacobian = numpy.where(offsets < 0, slopes_min, slopes_max)
+                if numpy.array_equal(new_jacobian, jacobian):
+                    break
+                jacobian = new_jacobian
+
+            for prop, col in prop_cols.items():
+                value = 0.5+offsets[col]
+                if mix:
+                    value = (self.character_data[prop]+value)/2
+                self.character_data[prop] = value
+
+            morph_values = {}
+            for modifier in fitting_modifiers.values():
+                names, weights = self.get_modifier_morph_values(modifier)
+                morph_values.update(zip(names, weights))
+            self.morph_engine.apply_morph_values(morph_values)
+            algorithms.print_log_report("INFO","Measures fitting (least squares) in {0} secs".format(time.time()-time1))
+
+
     def save_character(self, filepath, export_proportions=True, export_materials=True, export_metadata = True):
         algorithms.print_log_report("INFO","Exporting character to {0}".format(algorithms.simple_path(filepath)))
         obj = self.get_object()
@@ -1011,9 +1351,7 @@ class Humanoid:
 
         if obj:
 
-            for prop in self.character_data.keys():
-                if self.character_data[prop] != 0.5:
-                    char_data["structural"][prop] = round(self.character_data[prop], 4)
+            char_data["structural"] = self.character_data.get_changed_values(roundness=4)
 
             if export_metadata:
                 for meta_data_prop, value in self.character_metaproperties.items():
@@ -1083,20 +1421,7 @@ class Humanoid:
             meta_data = {}
 
         if char_data != None:
-            for name in self.character_data.keys():
-                if reset_string in name:
-                    self.character_data[name] = 0.5
-                if name in char_data:
-                    if mix:
-                        self.character_data[name] = (self.character_data[name]+char_data[name])/2
-                    else:
-                        self.character_data[name] = char_data[name]
-                else:
-                    if reset_unassigned:
-                        if mix:
-                            self.character_data[name] = (self.character_data[name]+0.5)/2
-                        else:
-                            self.character_data[name] = 0.5
+            self.character_data.load_values(char_data, reset_string, reset_unassigned, mix)
 
 
         for name in self.character_metaproperties.keys():
@@ -1130,14 +1455,16 @@ class Humanoid:
         self.mat_engine.load_texture(filepath, "body_displ")
 
 
-    def combine_morphings(self, modifier, refresh_only=False, add_vertices_to_update=True):
+    def get_modifier_morph_values(self, modifier, character_data=None):
         """
-        Mix shapekeys using smart combo algorithm.
+        Return the names and the weights of the morphs
+        of the modifier, using smart combo algorithm.
         """
-
+        if character_data is None:
+            character_data = self.character_data
         values = []
         for prop in modifier.properties:
-            val = self.character_data[prop]
+            val = character_data[prop]
             if val > 1.0:
                 val = 1.0
             if val < 0:
@@ -1145,7 +1472,13 @@ class Humanoid:
             val1 = algorithms.function_modifier_a(val)
             val2 = algorithms.function_modifier_b(val)
             values.append([val1, val2])
-        names, weights = algorithms.smart_combo(modifier.name, values)
+        return algorithms.smart_combo(modifier.name, values)
+
+    def combine_morphings(self, modifier, refresh_only=False, add_vertices_to_update=True):
+        """
+        Mix shapekeys using smart combo algorithm.
+        """
+        names, weights = self.get_modifier_morph_values(modifier)
         for i in range(len(names)):
             if refresh_only:
                 self.morph_engine.morph_values[names[i]] = weights[i]
@@ -1156,6 +1489,20 @@ class Humanoid:
                     add_vertices_to_update)
 
 
+    def combine_all_morphings(self):
+        """
+        Mix the shapekeys of all the modifiers and
+        apply them to the mesh in a single pass.
+        """
+        morph_values = {}
+        for category in self.get_categories():
+            for modifier in category.get_modifiers():
+                names, weights = self.get_modifier_morph_values(modifier)
+                for i in range(len(names)):
+                    morph_values[names[i]] = weights[i]
+        self.morph_engine.apply_morph_values(morph_values)
+
+
     def load_obj_prototype(self,obj_name):
 
         obj_path = os.path.join(self.data_path,"shared_objs",obj_name+".obj")
@@ -19,11 +19,27 @@ import bpy
 import os
 import time
 import json
-from . import algorithms
+from . import algorithms, dataloader
+
+
+def preload_databases(data_loader, character_config):
+    """
+    Read the texture files in background. The images are loaded
+    in Blender by the main thread, from the warm OS cache.
+    """
+    texture_data_path = os.path.join(algorithms.get_data_path(),"textures")
+    image_file_names = [
+        character_config["texture_displacement"],
+        character_config["texture_diffuse"],
+        character_config["name"]+"_displ.png"]
+    for image_file_name in image_file_names:
+        img_path = os.path.join(texture_data_path, image_file_name)
+        data_loader.submit("textures", img_path, dataloader.read_file, img_path)
+
 
 class MaterialEngine:
 
-    def __init__(self, obj_name, character_config):
+    def __init__(self, obj_name, character_config, data_loader=None):
 
         data_path = algorithms.get_data_path()
         self.obj_name = obj_name
@@ -60,13 +76,15 @@ class MaterialEngine:
         if os.path.isfile(self.image_file_paths["displ_data"]):
             self.texture_displace_exist = True
 
-        self.load_data_images()
+        self.load_data_images(data_loader)
         self.generate_displacement_image()
 
 
 
-    def load_data_images(self):
+    def load_data_images(self, data_loader=None):
         for img_path in self.image_file_paths.values():
+            if data_loader:
+                data_loader.get(img_path, dataloader.read_file, img_path)
             algorithms.load_image(img_path)
 
     def load_texture(self, img_path, shader_target):
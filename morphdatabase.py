@@ -0,0 +1,592 @@
+#ManuelbastioniLAB - Copyright (C) 2015-2018 Manuel Bastioni
+#Official site: www.manuelbastioni.com
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import struct
+import time
+import threading
+import hashlib
+import numpy
+from . import algorithms
+
+#Layout of a compiled morph database:
+#header | names (utf-8, separated by newlines) | offsets int32 (n_morphs+1) |
+#vertex indices int32 (n_deltas) | deltas float32 (n_deltas x 3)
+#The offsets delimit the deltas of each morph, in the same order of the names.
+MORPHS_MAGIC = b"MBMD"
+MORPHS_VERSION = 1
+MORPHS_HEADER = struct.Struct("<4sIIIIQd")
+MORPHS_EXTENSION = ".mbmorph"
+AXIS_MASKS = {"X":(1.0, 0.0, 0.0), "Y":(0.0, 1.0, 0.0), "Z":(0.0, 0.0, 1.0)}
+PROPORTIONS_EXTENSION = ".mbprop.npz"
+
+
+class MorphDatabase:
+    """
+    Read-only collection of morphs stored as contiguous arrays.
+    When the database comes from a compiled file, only the index
+    (names and offsets) is read at creation: the payload (indices
+    and deltas) is mapped on the first request.
+    """
+
+    def __init__(self, names, offsets, indices=None, deltas=None, filepath=None, payload_offset=0):
+        self.names = names
+        self.offsets = offsets
+        self.indices = indices
+        self.deltas = deltas
+        self.filepath = filepath
+        self.payload_offset = payload_offset
+        self.buffer = None
+        self.payload_lock = threading.Lock()
+        self.rows = {}
+        for row, name in enumerate(names):
+            self.rows[name] = row
+
+    def __contains__(self, morph_name):
+        return morph_name in self.rows
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "MorphDatabase with {0} morphs and {1} deltas".format(
+            len(self.names),
+            int(self.offsets[-1]))
+
+    def is_loaded(self):
+        return self.deltas is not None
+
+    def load_payload(self):
+        """
+        Memory-map the payload of the compiled file. The arrays are
+        read-only views of the map, so the pages are shared between
+        processes and only the touched ones become resident.
+        """
+        with self.payload_lock:
+            if self.deltas is None:
+                n_deltas = int(self.offsets[-1])
+                with open(self.filepath, "rb") as compiled_file:
+                    self.buffer = mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.indices = numpy.frombuffer(
+                    self.buffer, dtype="<i4", count=n_deltas,
+                    offset=self.payload_offset)
+                self.deltas = numpy.frombuffer(
+                    self.buffer, dtype="<f4", count=n_deltas*3,
+                    offset=self.payload_offset+self.indices.nbytes).reshape((n_deltas, 3))
+
+    def prefetch(self):
+        """
+        Read the payload file in the OS page cache and map it.
+        File reads release the GIL, so this can run in a background thread.
+        """
+        if self.deltas is None:
+            with open(self.filepath, "rb") as compiled_file:
+                compiled_file.seek(self.payload_offset)
+                while compiled_file.read(1048576):
+                    pass
+            self.load_payload()
+
+    def get_morph(self, morph_name):
+        """
+        Return the vertex indices and the deltas of the morph
+        as views of the database arrays (no copy).
+        """
+        if self.deltas is None:
+            self.load_payload()
+        row = self.rows[morph_name]
+        start = self.offsets[row]
+        end = self.offsets[row+1]
+        return (self.indices[start:end], self.deltas[start:end])
+
+    def weighted_sum(self, weights, n_verts):
+        """
+        Return the product W·Δ as a (n_verts x 3) array,
+        where weights contains one value for each morph.
+        """
+        if self.deltas is None:
+            self.load_payload()
+        delta_weights = numpy.repeat(weights, numpy.diff(self.offsets))
+        result = numpy.empty((n_verts, 3))
+        for axis in range(3):
+            axis_sum = numpy.bincount(
+                self.indices,
+                weights=self.deltas[:, axis]*delta_weights,
+                minlength=n_verts)
+            result[:, axis] = axis_sum[:n_verts]
+        return result
+
+
+class BoundingBoxDatabase:
+    """
+    Bounding boxes used to correct the morphs. Each row contains
+    the indices of the 6 vertices that delimit the box around
+    a vertex, and vertex_rows maps a vertex to its row (-1 if the
+    vertex has no box).
+    """
+
+    def __init__(self, vertices, indices):
+        self.vertices = vertices
+        self.indices = indices
+        n_rows = int(vertices.max())+1 if len(vertices) else 0
+        self.vertex_rows = numpy.full(n_rows, -1, dtype=numpy.int32)
+        self.vertex_rows[vertices] = numpy.arange(len(vertices), dtype=numpy.int32)
+
+    def __contains__(self, vert_index):
+        return 0 <= vert_index < len(self.vertex_rows) and self.vertex_rows[vert_index] >= 0
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def __repr__(self):
+        return "BoundingBoxDatabase with {0} boxes".format(len(self.vertices))
+
+    def get_rows(self, vert_indices):
+        """
+        Return the rows of the vertices, -1 for the vertices without box.
+        """
+        rows = numpy.full(len(vert_indices), -1, dtype=numpy.int32)
+        in_range = (vert_indices >= 0) & (vert_indices < len(self.vertex_rows))
+        rows[in_range] = self.vertex_rows[vert_indices[in_range]]
+        return rows
+
+
+class MeasuresDatabase:
+    """
+    Strips of the measures compiled in segments. The segments of
+    each measure are contiguous and delimited by the offsets. The
+    axis mask of a segment selects the components of its length:
+    a measure name ending with X, Y or Z is measured only along
+    that axis, the others in 3D.
+    """
+
+    def __init__(self, measures_data):
+        self.names = list(measures_data.keys())
+        self.rows = {}
+        self.offsets = numpy.zeros(len(self.names)+1, dtype=numpy.int32)
+        starts = []
+        ends = []
+        masks = []
+        for row, measure_name in enumerate(self.names):
+            self.rows[measure_name] = row
+            indices = measures_data[measure_name]
+            axis = measure_name[-1]
+            if axis in AXIS_MASKS:
+                mask = AXIS_MASKS[axis]
+            else:
+                mask = (1.0, 1.0, 1.0)
+            n_segments = max(len(indices)-1, 0)
+            starts.extend(indices[:-1])
+            ends.extend(indices[1:])
+            masks.extend([mask]*n_segments)
+            self.offsets[row+1] = self.offsets[row] + n_segments
+        self.segment_starts = numpy.array(starts, dtype=numpy.int32)
+        self.segment_ends = numpy.array(ends, dtype=numpy.int32)
+        self.segment_masks = numpy.array(masks, dtype=numpy.float64).reshape((-1, 3))
+        self.segment_rows = numpy.repeat(
+            numpy.arange(len(self.names), dtype=numpy.int32),
+            numpy.diff(self.offsets))
+
+        #Reverse index: vertex_measures[i, row] is True if the
+        #measure in row uses the vertex strip_vertices[i]
+        strip_vertices = set()
+        for indices in measures_data.values():
+            strip_vertices.update(indices)
+        self.strip_vertices = numpy.array(sorted(strip_vertices), dtype=numpy.int32)
+        self.vertex_measures = numpy.zeros((len(self.strip_vertices), len(self.names)), dtype=bool)
+        for row, measure_name in enumerate(self.names):
+            positions = numpy.searchsorted(self.strip_vertices, measures_data[measure_name])
+            self.vertex_measures[positions, row] = True
+
+    def __contains__(self, measure_name):
+        return measure_name in self.rows
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "MeasuresDatabase with {0} measures and {1} segments".format(
+            len(self.names),
+            len(self.segment_starts))
+
+    def get_vertices_measures(self, moved_vertices):
+        """
+        Return the mask of the measures that use at least one of the
+        strip vertices selected by the boolean array moved_vertices.
+        """
+        return numpy.any(self.vertex_measures[moved_vertices], axis=0)
+
+    def segments_lengths(self, verts_coo, segments=slice(None)):
+        verts_coo = numpy.asarray(verts_coo, dtype=numpy.float64)
+        diffs = verts_coo[self.segment_ends[segments]] - verts_coo[self.segment_starts[segments]]
+        diffs *= self.segment_masks[segments]
+        return numpy.sqrt(numpy.einsum("ij,ij->i", diffs, diffs))
+
+    def measure_length(self, verts_coo, measure_name):
+        row = self.rows[measure_name]
+        return float(self.segments_lengths(verts_coo, slice(self.offsets[row], self.offsets[row+1])).sum())
+
+    def measures_lengths(self, verts_coo, rows_mask=None):
+        """
+        Return the dict {measure_name:length} of the measures
+        selected by rows_mask, or of all the measures if it is None.
+        """
+        if rows_mask is None:
+            segments = slice(None)
+            names = self.names
+        else:
+            segments = rows_mask[self.segment_rows]
+            names = [self.names[row] for row in numpy.flatnonzero(rows_mask)]
+        lengths = numpy.bincount(
+            self.segment_rows[segments],
+            weights=self.segments_lengths(verts_coo, segments),
+            minlength=len(self.names))
+        if rows_mask is not None:
+            lengths = lengths[rows_mask]
+        return dict(zip(names, lengths.tolist()))
+
+
+class JointsDatabase:
+    """
+    Joints of the skeleton compiled in a sparse averaging matrix:
+    the location of a joint is the mean of its vertices plus its
+    offset. The vertices of each joint are stored in the entries
+    with the same joint row.
+    """
+
+    def __init__(self, joints_data, offsets_data=None):
+        self.names = list(joints_data.keys())
+        self.rows = {}
+        vertices = []
+        counts = []
+        for row, joint_name in enumerate(self.names):
+            self.rows[joint_name] = row
+            vertices.extend(joints_data[joint_name])
+            counts.append(len(joints_data[joint_name]))
+        counts = numpy.array(counts, dtype=numpy.int32)
+        self.entry_vertices = numpy.array(vertices, dtype=numpy.int32)
+        self.entry_rows = numpy.repeat(numpy.arange(len(self.names), dtype=numpy.int32), counts)
+        #The joints without vertices are placed at the origin, as average_center does
+        self.entry_weights = 1.0/counts[self.entry_rows]
+        self.offsets = numpy.zeros((len(self.names), 3), dtype=numpy.float64)
+        if offsets_data:
+            for joint_name, offset in offsets_data.items():
+                if joint_name in self.rows:
+                    self.offsets[self.rows[joint_name]] = offset
+
+    def __contains__(self, joint_name):
+        return joint_name in self.rows
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "JointsDatabase with {0} joints and {1} vertices".format(
+            len(self.names),
+            len(self.entry_vertices))
+
+    def joints_locations(self, verts_coo):
+        """
+        Return the (N x 3) array of the joint locations.
+        """
+        verts_coo = numpy.asarray(verts_coo, dtype=numpy.float64)
+        weighted_coords = verts_coo[self.entry_vertices]*self.entry_weights[:, None]
+        locations = numpy.empty((len(self.names), 3), dtype=numpy.float64)
+        for axis in range(3):
+            locations[:, axis] = numpy.bincount(
+                self.entry_rows,
+                weights=weighted_coords[:, axis],
+                minlength=len(self.names))
+        return locations + self.offsets
+
+
+class ProportionsDatabase:
+    """
+    Proportion indices (N x 5) of the bodies in an anthropometry
+    folder. With a few thousands of bodies a brute force search
+    on the matrix takes some microseconds, so no tree is needed.
+    """
+
+    def __init__(self, folder_path, filenames, proportions):
+        self.folder_path = folder_path
+        self.filenames = filenames
+        self.proportions = proportions
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __repr__(self):
+        return "ProportionsDatabase with {0} bodies".format(len(self.filenames))
+
+    def nearest(self, proportion_index, n_results=None):
+        """
+        Return the list [(distance, filepath),...] of the n_results
+        bodies nearest to proportion_index, sorted by distance.
+        """
+        deltas = self.proportions - numpy.asarray(proportion_index, dtype=numpy.float64)
+        distances = numpy.sqrt(numpy.einsum("ij,ij->i", deltas, deltas))
+        if n_results is None or n_results >= len(distances):
+            order = numpy.argsort(distances, kind="stable")
+        else:
+            nearest_rows = numpy.argpartition(distances, n_results-1)[:n_results]
+            order = nearest_rows[numpy.argsort(distances[nearest_rows], kind="stable")]
+        return [
+            (float(distances[row]), os.path.join(self.folder_path, self.filenames[row]))
+            for row in order.tolist()]
+
+
+def get_folder_signature(folder_path):
+    """
+    Return the sorted json files of the folder and a digest of
+    their names, sizes and modification times.
+    """
+    entries = []
+    for entry in os.scandir(folder_path):
+        if entry.is_file() and os.path.splitext(entry.name)[1] == ".json":
+            entry_stat = entry.stat()
+            entries.append((entry.name, entry_stat.st_size, entry_stat.st_mtime_ns))
+    entries.sort()
+    digest = hashlib.sha1(repr(entries).encode("utf-8")).hexdigest()
+    return [entry[0] for entry in entries], digest
+
+
+def compile_proportions_database(folder_path, filenames):
+    valid_filenames = []
+    proportions = []
+    for filename in filenames:
+        char_data = algorithms.load_json_data(os.path.join(folder_path, filename),"Proportions data",use_cache=False)
+        if char_data and "proportion_index" in char_data:
+            valid_filenames.append(filename)
+            proportions.append(char_data["proportion_index"])
+        else:
+            algorithms.print_log_report("INFO","File {0} does not contain proportions".format(filename))
+    proportions = numpy.array(proportions, dtype=numpy.float64).reshape((len(valid_filenames), -1))
+    return valid_filenames, proportions
+
+
+def load_proportions_database(folder_path):
+    """
+    Return the ProportionsDatabase of the anthropometry folder. The
+    matrix is stored in the cache folder and rebuilt only when a
+    file of the folder is added, removed or modified.
+    """
+    time1 = time.time()
+    filenames, signature = get_folder_signature(folder_path)
+    cache_path = algorithms.get_cache_path()
+    compiled_path = None
+    if cache_path:
+        compiled_path = os.path.join(
+            cache_path,
+            os.path.basename(os.path.normpath(folder_path))+PROPORTIONS_EXTENSION)
+        if os.path.isfile(compiled_path):
+            try:
+                with numpy.load(compiled_path) as compiled_data:
+                    if str(compiled_data["signature"]) == signature:
+                        return ProportionsDatabase(
+                            folder_path,
+                            compiled_data["filenames"].tolist(),
+                            compiled_data["proportions"])
+            except (OSError, KeyError, ValueError):
+                algorithms.print_log_report("WARNING","Corrupted proportions index {0}".format(algorithms.simple_path(compiled_path)))
+
+    valid_filenames, proportions = compile_proportions_database(folder_path, filenames)
+    if compiled_path:
+        temp_path = "{0}.{1}.tmp".format(compiled_path, os.getpid())
+        try:
+            with open(temp_path, "wb") as compiled_file:
+                numpy.savez(
+                    compiled_file,
+                    signature=numpy.array(signature),
+                    filenames=numpy.array(valid_filenames),
+                    proportions=proportions)
+            os.replace(temp_path, compiled_path)
+        except OSError:
+            algorithms.print_log_report("WARNING","Cannot write the proportions index {0}".format(algorithms.simple_path(compiled_path)))
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+    algorithms.print_log_report("INFO","Proportions index of {0} bodies compiled in {1} secs".format(len(valid_filenames),time.time()-time1))
+    return ProportionsDatabase(folder_path, valid_filenames, proportions)
+
+
+def bboxes_from_json_data(b_data):
+    """
+    Convert the json boxes {vert_index:[6 indices]} in
+    the arrays used by BoundingBoxDatabase.
+    """
+    vertices = numpy.array([int(vert_index) for vert_index in b_data.keys()], dtype=numpy.int32)
+    indices = numpy.array(list(b_data.values()), dtype=numpy.int32).reshape((-1, 6))
+    return vertices, indices
+
+
+def load_bbox_database(json_path):
+    b_data = algorithms.load_json_data(json_path,"Bounding box data")
+    if b_data:
+        return BoundingBoxDatabase(*bboxes_from_json_data(b_data))
+    return None
+
+
+def prefetch_databases(databases):
+    """
+    Load the payload of the databases in a daemon thread.
+    """
+    def prefetch_all():
+        for m_database in databases:
+            try:
+                m_database.prefetch()
+            except (OSError, ValueError):
+                algorithms.print_log_report("WARNING","Prefetch of {0} failed".format(algorithms.simple_path(m_database.filepath)))
+    prefetch_thread = threading.Thread(target=prefetch_all, daemon=True)
+    prefetch_thread.start()
+    return prefetch_thread
+
+
+def get_compiled_path(json_path):
+    cache_path = algorithms.get_cache_path()
+    if cache_path:
+        root_name = os.path.splitext(os.path.basename(json_path))[0]
+        return os.path.join(cache_path, root_name+MORPHS_EXTENSION)
+    return None
+
+
+def morphs_from_json_data(m_data):
+    """
+    Convert the json morphs {name:[[idx,dx,dy,dz],...]} in
+    the arrays used by MorphDatabase.
+    """
+    names = list(m_data.keys())
+    offsets = numpy.zeros(len(names)+1, dtype=numpy.int32)
+    for row, morph_name in enumerate(names):
+        offsets[row+1] = offsets[row] + len(m_data[morph_name])
+
+    n_deltas = int(offsets[-1])
+    indices = numpy.empty(n_deltas, dtype=numpy.int32)
+    deltas = numpy.empty((n_deltas, 3), dtype=numpy.float32)
+    for row, morph_name in enumerate(names):
+        morph_deltas = m_data[morph_name]
+        if morph_deltas:
+            d_array = numpy.array(morph_deltas, dtype=numpy.float64)
+            indices[offsets[row]:offsets[row+1]] = d_array[:, 0]
+            deltas[offsets[row]:offsets[row+1]] = d_array[:, 1:4]
+    return names, offsets, indices, deltas
+
+
+def compile_morphs_database(json_path, compiled_path):
+    """
+    Compile the json morph database in a packed binary file.
+    Return True if the file is written.
+    """
+    time1 = time.time()
+    m_data = algorithms.load_json_data(json_path,"Morph data",use_cache=False)
+    if not m_data:
+        return False
+
+    names, offsets, indices, deltas = morphs_from_json_data(m_data)
+    names_data = "\n".join(names).encode("utf-8")
+    names_data += b"\0"*(-len(names_data) % 4)
+    source_stat = os.stat(json_path)
+    header = MORPHS_HEADER.pack(
+        MORPHS_MAGIC,
+        MORPHS_VERSION,
+        len(names),
+        len(indices),
+        len(names_data),
+        source_stat.st_size,
+        source_stat.st_mtime)
+
+    #Write in a temporary file and then rename it, so other
+    #Blender instances never map a partially written database
+    temp_path = "{0}.{1}.tmp".format(compiled_path, os.getpid())
+    try:
+        with open(temp_path, "wb") as compiled_file:
+            compiled_file.write(header)
+            compiled_file.write(names_data)
+            compiled_file.write(offsets.astype("<i4").tobytes())
+            compiled_file.write(indices.astype("<i4").tobytes())
+            compiled_file.write(deltas.astype("<f4").tobytes())
+        os.replace(temp_path, compiled_path)
+    except OSError:
+        algorithms.print_log_report("WARNING","Cannot write the compiled database {0}".format(algorithms.simple_path(compiled_path)))
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        return False
+    algorithms.print_log_report("INFO","Morph database {0} compiled in {1} secs".format(algorithms.simple_path(json_path),time.time()-time1))
+    return True
+
+
+def read_compiled_header(compiled_path):
+    with open(compiled_path, "rb") as compiled_file:
+        header_data = compiled_file.read(MORPHS_HEADER.size)
+    if len(header_data) != MORPHS_HEADER.size:
+        return None
+    header = MORPHS_HEADER.unpack(header_data)
+    if header[0] != MORPHS_MAGIC or header[1] != MORPHS_VERSION:
+        return None
+    return header
+
+
+def is_compiled_database_valid(json_path, compiled_path):
+    """
+    The compiled file is valid if it was built from a source
+    json with the same size and modification time.
+    """
+    if not os.path.isfile(compiled_path):
+        return False
+    header = read_compiled_header(compiled_path)
+    if not header:
+        return False
+    source_stat = os.stat(json_path)
+    return header[5] == source_stat.st_size and header[6] == source_stat.st_mtime
+
+
+def open_compiled_database(compiled_path):
+    """
+    Read the index of the compiled database. The payload is
+    mapped later, by MorphDatabase.load_payload.
+    """
+    with open(compiled_path, "rb") as compiled_file:
+        header = MORPHS_HEADER.unpack(compiled_file.read(MORPHS_HEADER.size))
+        magic, version, n_morphs, n_deltas, names_size, source_size, source_mtime = header
+
+        names_data = compiled_file.read(names_size).rstrip(b"\0")
+        names = names_data.decode("utf-8").split("\n") if n_morphs else []
+        offsets = numpy.frombuffer(compiled_file.read(4*(n_morphs+1)), dtype="<i4")
+
+    payload_offset = MORPHS_HEADER.size + names_size + offsets.nbytes
+    return MorphDatabase(names, offsets, filepath=compiled_path, payload_offset=payload_offset)
+
+
+def load_morphs_database(json_path):
+    """
+    Return the MorphDatabase of the json file, compiling it
+    when the binary version is missing or stale.
+    """
+    if not os.path.isfile(json_path):
+        if algorithms.simple_path(json_path) != "":
+            algorithms.print_log_report("WARNING","File not found: {0}".format(algorithms.simple_path(json_path)))
+        return None
+
+    compiled_path = get_compiled_path(json_path)
+    if compiled_path:
+        if not is_compiled_database_valid(json_path, compiled_path):
+            compile_morphs_database(json_path, compiled_path)
+        if is_compiled_database_valid(json_path, compiled_path):
+            return open_compiled_database(compiled_path)
+
+    #Cache not writable: keep the arrays in memory
+    m_data = algorithms.load_json_data(json_path,"Morph data")
+    if m_data:
+        names, offsets, indices, deltas = morphs_from_json_data(m_data)
+        return MorphDatabase(names, offsets, indices, deltas)
+    return None
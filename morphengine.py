@@ -15,17 +15,55 @@
 
 import os
 import bpy
-import mathutils
-from . import algorithms, proxyengine
+from . import algorithms, proxyengine, morphdatabase, dataloader
 import time, json
-import operator
+import hashlib
+import numpy
+
+def get_database_paths(character_config):
+    """
+    Return the paths of the databases used by the engine.
+    The morph databases are listed in loading order.
+    """
+    data_path = algorithms.get_data_path()
+    morphs_path = os.path.join(data_path, "morphs")
+    morphs_data_paths = [
+        os.path.join(morphs_path, character_config["shared_morphs_file"]),
+        os.path.join(morphs_path, character_config["name"]+"_morphs.json"),
+        os.path.join(morphs_path, character_config["morphs_extra_file"])]
+    if character_config["shared_morphs_extra_file"] != "":
+        morphs_data_paths.append(
+            os.path.join(morphs_path, character_config["shared_morphs_extra_file"]))
+    morphs_data_paths.append(
+        os.path.join(data_path, "expressions_morphs", character_config["name"]+"_exprs.json"))
+
+    return {
+        "vertices": os.path.join(data_path, "vertices", character_config["name"]+"_verts.json"),
+        "morphs": morphs_data_paths,
+        "bboxes": os.path.join(data_path, "bboxes", character_config["bounding_boxes_file"]),
+        "measures": os.path.join(data_path, "measures", character_config["measures_file"])}
+
+
+def preload_databases(data_loader, character_config):
+    database_paths = get_database_paths(character_config)
+    data_loader.submit("vertices", database_paths["vertices"],
+        algorithms.load_vertices_database, database_paths["vertices"])
+    for morph_data_path in database_paths["morphs"]:
+        data_loader.submit("morphs", morph_data_path,
+            morphdatabase.load_morphs_database, morph_data_path)
+    data_loader.submit("bboxes", database_paths["bboxes"],
+        morphdatabase.load_bbox_database, database_paths["bboxes"])
+    data_loader.submit("measures", database_paths["measures"],
+        algorithms.load_json_data, database_paths["measures"], "Measures data")
+
 
 class MorphingEngine:
 
-    def __init__(self, obj_name, character_config):
+    def __init__(self, obj_name, character_config, data_loader=None):
         time1 = time.time()
         data_path = algorithms.get_data_path()
-        self.final_form = []
+        #Coordinates (N x 3 float32 arrays) of the morphed and cached mesh
+        self.final_form = None
         self.cache_form = []
         self.obj_name = obj_name        
 
@@ -39,80 +77,61 @@ class MorphingEngine:
         self.shared_measures_filename = character_config["measures_file"]
         self.shared_bbox_filename = character_config["bounding_boxes_file"]
         self.measures_database_exist = False
-        
-        if self.shared_morphs_filename_extra != "":    
-            self.shared_morph_extra_data_path = os.path.join(
-                data_path,
-                "morphs",
-                self.shared_morphs_filename_extra)
-        else:
-            self.shared_morph_extra_data_path = None
 
-        self.measures_data_path = os.path.join(
-            data_path,
-            "measures",
-            self.shared_measures_filename)
+        database_paths = get_database_paths(character_config)
+        self.morphs_data_paths = database_paths["morphs"]
+        self.measures_data_path = database_paths["measures"]
+        self.bounding_box_path = database_paths["bboxes"]
+        self.vertices_path = database_paths["vertices"]
         self.bodies_data_path = os.path.join(
             data_path,
             "anthropometry",
             self.shared_anthropometric_path)
-        self.shared_morph_data_path = os.path.join(
-            data_path,
-            "morphs",
-            self.shared_morphs_filename)        
-        self.morph_data_path = os.path.join(
-            data_path,
-            "morphs",
-            self.morphs_filename)
-        self.extra_morph_data_path = os.path.join(
-            data_path,
-            "morphs",
-            self.morphs_filename_extra)
-        self.bounding_box_path = os.path.join(
-            data_path,
-            "bboxes",
-            self.shared_bbox_filename)
-        self.expressions_path = os.path.join(
-            data_path,
-            "expressions_morphs",
-            self.expressions_filename)
-        self.vertices_path = os.path.join(
-            data_path,
-            "vertices",
-            self.vertices_filename)
-
 
         if os.path.isdir(self.bodies_data_path):
             if os.path.isfile(self.measures_data_path):
                 self.measures_database_exist = True
 
-        self.verts_to_update = set()
+        self.verts_to_update = None
+        self.mesh_form = None
+        #morph_rows is the index of all the morphs, while morph_data
+        #contains only the morphs already requested (or corrected)
+        self.morph_databases = []
+        self.shared_databases = []
         self.morph_data = {}
+        self.morph_rows = {}
         self.morph_data_cache = {}
+        self.morph_correction_digests = {}
         self.forma_data = None
-        self.bbox_data = {}
+        self.bbox_data = None
+        self.base_bbox_extents = None
         self.morph_values = {}
-        self.morph_modified_verts = {}
         self.boundary_verts = None
         self.measures_data = {}
+        self.measures_strips = morphdatabase.MeasuresDatabase({})
+        #Measures of final_form and coordinates of the strip vertices
+        #when they were calculated
+        self.measures_cache = None
+        self.measures_snapshot = None
         self.measures_relat_data = []
         self.measures_score_weights = {}
         self.body_height_Z_parts = {}
 
         self.proportions = {}
         self.proportion_index = None
+        self.proportions_database = None
 
         self.init_final_form()
-        self.base_form = algorithms.load_vertices_database(self.vertices_path)
+        self.base_form = numpy.array(
+            dataloader.get_data(data_loader, self.vertices_path, algorithms.load_vertices_database, self.vertices_path),
+            dtype=numpy.float32).reshape((-1, 3))
 
-        self.load_morphs_database(self.shared_morph_data_path)
-        self.load_morphs_database(self.morph_data_path)
-        self.load_morphs_database(self.extra_morph_data_path) #Call this after the loading of shared morph is important for overwrite data.
-        if self.shared_morph_extra_data_path:
-            self.load_morphs_database(self.shared_morph_extra_data_path)
-        self.load_morphs_database(self.expressions_path)
-        self.load_bboxes_database(self.bounding_box_path)
-        self.load_measures_database(self.measures_data_path)
+        #The order is important: the extra morphs overwrite the shared ones
+        for morph_data_path in self.morphs_data_paths:
+            self.load_morphs_database(morph_data_path, data_loader)
+        self.load_bboxes_database(self.bounding_box_path, data_loader)
+        self.load_measures_database(self.measures_data_path, data_loader)
+        self.prefetch_morphs()
 
         self.measures = self.calculate_measures()
 
@@ -125,12 +144,14 @@ class MorphingEngine:
 
     def init_final_form(self):
         obj = self.get_object()
-        self.final_form = []
-        for vert in obj.data.vertices:
-                self.final_form.append(vert.co.copy())
+        self.final_form = algorithms.get_vertices_coords(obj)
+        #Preallocated buffers for the partial updates: the dirty bitmap
+        #and the copy of the mesh coordinates used for the write-back
+        self.verts_to_update = numpy.zeros(len(self.final_form), dtype=bool)
+        self.mesh_form = numpy.empty_like(self.final_form)
 
     def __repr__(self):
-        return "MorphEngine {0} with {1} morphings".format(self.obj_name, len(self.morph_data))
+        return "MorphEngine {0} with {1} morphings".format(self.obj_name, len(self.morph_rows))
 
     def get_object(self):
         if self.obj_name in bpy.data.objects:
@@ -141,44 +162,77 @@ class MorphingEngine:
         algorithms.print_log_report("WARNING","Database file not found: {0}".format(algorithms.simple_path(path)))
 
     def reset(self, update=True):
-        for i in range(len(self.base_form)):
-            self.final_form[i] = self.base_form[i]
+        self.final_form[:len(self.base_form)] = self.base_form
         for morph_name in self.morph_values.keys():
             self.morph_values[morph_name] = 0.0
         if update:
             self.update(update_all_verts=True)
 
-    def load_measures_database(self, measures_path):
-        m_database = algorithms.load_json_data(measures_path,"Measures data")
+    def load_measures_database(self, measures_path, data_loader=None):
+        m_database = self.acquire_database(measures_path, data_loader, algorithms.load_json_data, measures_path, "Measures data")
         if m_database:
             self.measures_data = m_database["measures"]
+            self.measures_strips = morphdatabase.MeasuresDatabase(self.measures_data)
+            self.measures_cache = None
             self.measures_relat_data = m_database["relations"]
             self.measures_score_weights = m_database["score_weights"]
             self.body_height_Z_parts = m_database["body_height_Z_parts"]
 
-    def load_bboxes_database(self, bounding_box_path):
-        self.bbox_data = algorithms.load_json_data(bounding_box_path,"Bounding box data")
-
-
-    def load_morphs_database(self, morph_data_path):
+    def load_bboxes_database(self, bounding_box_path, data_loader=None):
+        self.bbox_data = self.acquire_database(bounding_box_path, data_loader, morphdatabase.load_bbox_database, bounding_box_path)
+        self.base_bbox_extents = None
+
+    def acquire_database(self, data_path, data_loader, func, *args):
+        """
+        Get the read-only database from the registry shared by all the
+        characters. The database must not be modified by the engine.
+        """
+        database = dataloader.database_registry.acquire(
+            data_path, dataloader.get_data, data_loader, data_path, func, *args)
+        if database is not None:
+            self.shared_databases.append(data_path)
+        return database
+
+    def release_databases(self):
+        for data_path in self.shared_databases:
+            dataloader.database_registry.release(data_path)
+        self.shared_databases = []
+
+    def load_morphs_database(self, morph_data_path, data_loader=None):
         time1 = time.time()
-        m_data = algorithms.load_json_data(morph_data_path,"Morph data")
-        if m_data:
-            for morph_name, deltas in m_data.items():
-                morph_deltas = []
-                modified_verts = set()
-                for d_data in deltas:
-                    t_delta = mathutils.Vector(d_data[1:])
-                    morph_deltas.append([d_data[0], t_delta])
-                    modified_verts.add(d_data[0])
-                if morph_name in self.morph_data:
+        m_database = self.acquire_database(morph_data_path, data_loader, morphdatabase.load_morphs_database, morph_data_path)
+        if m_database:
+            self.morph_databases.append(m_database)
+            for morph_name in m_database.names:
+                if morph_name in self.morph_rows:
                     algorithms.print_log_report("WARNING","Morph {0} duplicated while loading morphs from file".format(morph_name))
+                    self.morph_data.pop(morph_name, None)
 
-                self.morph_data[morph_name] = morph_deltas
+                self.morph_rows[morph_name] = (m_database, m_database.rows[morph_name])
                 self.morph_values[morph_name] = 0.0
-                self.morph_modified_verts[morph_name] = modified_verts
             algorithms.print_log_report("INFO","Morph database {0} loaded in {1} secs".format(algorithms.simple_path(morph_data_path),time.time()-time1))
-            algorithms.print_log_report("INFO","Now local morph data contains {0} elements".format(len(self.morph_data)))
+            algorithms.print_log_report("INFO","Now local morph data contains {0} elements".format(len(self.morph_rows)))
+
+    def get_morph_names(self):
+        return list(self.morph_rows.keys())
+
+    def get_morph(self, morph_name):
+        """
+        Return the vertex indices and the deltas of the morph,
+        loading the payload of its database on the first request.
+        """
+        if morph_name not in self.morph_data:
+            m_database, row = self.morph_rows[morph_name]
+            self.morph_data[morph_name] = m_database.get_morph(morph_name)
+        return self.morph_data[morph_name]
+
+    def prefetch_morphs(self):
+        """
+        Load in a background thread the payloads not requested yet.
+        """
+        databases = [m_database for m_database in self.morph_databases if not m_database.is_loaded()]
+        if databases:
+            morphdatabase.prefetch_databases(databases)
 
 
     #def apply_finishing_morph(self):
@@ -196,21 +250,86 @@ class MorphingEngine:
 
     def calculate_measures(self,measure_name = None,vert_coords=None):
 
-        if not vert_coords:
+        if vert_coords is None:
             vert_coords = self.final_form
-        measures = {}
         time1 = time.time()
         if measure_name:
-            if measure_name in self.measures_data:
-                indices =  self.measures_data[measure_name]
-                axis = measure_name[-1]
-                return algorithms.length_of_strip(vert_coords, indices, axis)
+            if measure_name in self.measures_strips:
+                return self.measures_strips.measure_length(vert_coords, measure_name)
         else:
-            for measure_name in self.measures_data.keys():
-                measures[measure_name] = self.calculate_measures(measure_name, vert_coords)
+            if vert_coords is self.final_form:
+                measures = self.update_measures_cache()
+            else:
+                measures = self.measures_strips.measures_lengths(vert_coords)
             algorithms.print_log_report("DEBUG","Measures calculated in {0} secs".format(time.time()-time1))
             return measures
 
+    def add_strips_deltas(self, vert_coords, morph_values):
+        """
+        Add to vert_coords the morphs with the weights in morph_values,
+        only for the vertices used by the measure strips.
+        """
+        in_strips = numpy.zeros(len(vert_coords), dtype=bool)
+        in_strips[self.measures_strips.strip_vertices] = True
+        for morph_name, morph_value in morph_values.items():
+            if morph_value != 0.0 and morph_name in self.morph_rows:
+                morph_indices, morph_deltas = self.get_morph(morph_name)
+                strip_deltas = in_strips[morph_indices]
+                numpy.add.at(
+                    vert_coords,
+                    morph_indices[strip_deltas],
+                    morph_deltas[strip_deltas]*morph_value)
+
+    def calculate_morphed_measure(self, measure_name, morph_values):
+        """
+        Return the measure of the base form with the morphs set to
+        morph_values {morph_name:value}, without changing final_form.
+        """
+        vert_coords = self.base_form.astype(numpy.float64)
+        self.add_strips_deltas(vert_coords, morph_values)
+        return self.measures_strips.measure_length(vert_coords, measure_name)
+
+    def calculate_morphed_measures(self, morph_values):
+        """
+        Return all the measures of final_form with the morphs set to
+        morph_values {morph_name:value}, without changing final_form.
+        """
+        vert_coords = self.final_form.astype(numpy.float64)
+        real_values = {}
+        for morph_name, morph_value in morph_values.items():
+            if morph_name in self.morph_values:
+                real_values[morph_name] = morph_value - self.morph_values[morph_name]
+        self.add_strips_deltas(vert_coords, real_values)
+        return self.measures_strips.measures_lengths(vert_coords)
+
+    def get_databases_signature(self):
+        """
+        Return a digest of the source files of the morphs, measures
+        and vertices, used to validate the data cached from them.
+        """
+        files_data = []
+        for data_path in self.morphs_data_paths+[self.measures_data_path, self.vertices_path]:
+            if os.path.isfile(data_path):
+                data_stat = os.stat(data_path)
+                files_data.append((os.path.basename(data_path), data_stat.st_size, data_stat.st_mtime_ns))
+        return hashlib.sha1(repr(files_data).encode("utf-8")).hexdigest()
+
+    def update_measures_cache(self):
+        """
+        Recalculate only the measures whose strips contain vertices
+        moved since the last call, and return a copy of all the values.
+        """
+        strip_coords = self.final_form[self.measures_strips.strip_vertices]
+        if self.measures_cache is None or len(self.measures_snapshot) != len(strip_coords):
+            self.measures_cache = self.measures_strips.measures_lengths(self.final_form)
+        else:
+            moved_vertices = numpy.any(strip_coords != self.measures_snapshot, axis=1)
+            rows_mask = self.measures_strips.get_vertices_measures(moved_vertices)
+            if rows_mask.any():
+                self.measures_cache.update(self.measures_strips.measures_lengths(self.final_form, rows_mask))
+        self.measures_snapshot = strip_coords
+        return dict(self.measures_cache)
+
     def calculate_proportions(self, measures):
 
         if measures == None:
@@ -232,27 +351,17 @@ class MorphingEngine:
             algorithms.print_log_report("ERROR","The 'body_height_Z' measure not present in the analyzed database")
 
 
-    def compare_file_proportions(self,filepath):
-        char_data = algorithms.load_json_data(filepath,"Proportions data")
-        if "proportion_index" in char_data:
-            v1 = mathutils.Vector(self.proportion_index)
-            v2 = mathutils.Vector(char_data["proportion_index"])
-            delta_v = v2-v1
-
-            return (delta_v.length,filepath)
-        else:
-            algorithms.print_log_report("INFO","File {0} does not contain proportions".format(algorithms.simple_path(filepath)))
-
-
-    def compare_data_proportions(self):
+    def compare_data_proportions(self, n_results=None):
+        """
+        Return the list [(distance, filepath),...] of the bodies with
+        proportions nearest to proportion_index, sorted by distance.
+        """
         scores = []
         time1 = time.time()
         if os.path.isdir(self.bodies_data_path):
-            for database_file in os.listdir(self.bodies_data_path):
-                body_data, extension = os.path.splitext(database_file)
-                if "json" in extension:
-                    scores.append(self.compare_file_proportions(os.path.join(self.bodies_data_path,database_file)))
-            scores.sort(key=operator.itemgetter(0), reverse=False)
+            if self.proportions_database is None:
+                self.proportions_database = morphdatabase.load_proportions_database(self.bodies_data_path)
+            scores = self.proportions_database.nearest(self.proportion_index, n_results)
             algorithms.print_log_report("INFO","Measures compared with database in {0} seconds".format(time.time()-time1))
         else:
             algorithms.print_log_report("WARNING","Bodies database not found")
@@ -262,36 +371,57 @@ class MorphingEngine:
 
 
     def correct_morphs(self, names):
-        morph_values_cache = {}
-        for morph_name in self.morph_data.keys():
-            for name in names:
-                if name in morph_name:
-                    morph_values_cache[morph_name] = self.morph_values[morph_name]#Store the values before the correction
-                    self.calculate_morph(morph_name, 0.0) #Reset the morphs to correct
-
-        for morph_name, morph_deltas in self.morph_data.items():
-            for name in names:
-                if name in morph_name: #If the morph is in the list of morph to correct
-                    if morph_name in self.morph_data_cache:
-                        morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
-                    else:
-                        self.morph_data_cache[morph_name] = morph_deltas
-                        morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
-
-                    self.morph_data[morph_name] = algorithms.correct_morph(
-                        self.base_form,
-                        self.final_form,
-                        morph_deltas_to_recalculate,
-                        self.bbox_data)
-        for morph_name in self.morph_data.keys():
+        """
+        Correct the morphs that contain one of the names according
+        to the current shape. Each correction is stored with a digest
+        of the boxes it depends on, so only the morphs whose regions
+        changed since the last call are recomputed.
+        """
+        if self.bbox_data is None:
+            algorithms.print_log_report("WARNING","Morphs not corrected: bounding box data not available")
+            return
+        time1 = time.time()
+        morphs_to_correct = []
+        for morph_name in self.morph_rows.keys():
             for name in names:
                 if name in morph_name:
-                    self.calculate_morph(
-                        morph_name,
-                        morph_values_cache[morph_name])
+                    morphs_to_correct.append(morph_name)
+                    break
+
+        #The boxes are measured on the shape without the morphs to correct
+        uncorrected_form = self.final_form.copy()
+        for morph_name in morphs_to_correct:
+            morph_value = self.morph_values[morph_name]
+            if morph_value != 0.0:
+                morph_indices, morph_deltas = self.get_morph(morph_name)
+                numpy.add.at(uncorrected_form, morph_indices, morph_deltas*(-morph_value))
+
+        if self.base_bbox_extents is None:
+            self.base_bbox_extents = algorithms.bounding_boxes_extents(self.base_form, self.bbox_data.indices)
+        current_extents = algorithms.bounding_boxes_extents(uncorrected_form, self.bbox_data.indices)
+        bbox_scales = algorithms.bounding_boxes_scales(self.base_bbox_extents, current_extents)
+
+        n_corrected = 0
+        for morph_name in morphs_to_correct:
+            if morph_name not in self.morph_data_cache:
+                self.morph_data_cache[morph_name] = self.get_morph(morph_name)
+            morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
+            bbox_rows = self.bbox_data.get_rows(morph_deltas_to_recalculate[0])
+            bbox_digest = hashlib.sha1(current_extents[bbox_rows[bbox_rows >= 0]].tobytes()).digest()
+
+            if self.morph_correction_digests.get(morph_name) != bbox_digest:
+                morph_value = self.morph_values[morph_name]
+                self.calculate_morph(morph_name, 0.0) #Remove the old correction
+                self.morph_data[morph_name] = algorithms.correct_morph(
+                    morph_deltas_to_recalculate,
+                    self.bbox_data,
+                    bbox_scales)
+                self.calculate_morph(morph_name, morph_value)
+                self.morph_correction_digests[morph_name] = bbox_digest
+                n_corrected += 1
         self.update()
-
-
+        algorithms.print_log_report("INFO","Corrected {0} of {1} morphs in {2} secs".format(
+            n_corrected, len(morphs_to_correct), time.time()-time1))
 
     def convert_all_to_blshapekeys(self):
 
@@ -299,34 +429,29 @@ class MorphingEngine:
 
         obj = self.get_object()
         #Reset all values (for expressions only) and create the basis key
-        for morph_name in self.morph_data.keys():
+        for morph_name in self.morph_rows.keys():
             if "Expression" in morph_name:
                 self.calculate_morph(morph_name, 0.0)
-                self.update()
-        algorithms.new_shapekey(obj, "basis")         
-     
+        self.update()
+        algorithms.new_shapekey(obj, "basis")
+
 
         #Store the character in neutral expression
-        obj = self.get_object()
-        stored_vertices = []
-        for vert in obj.data.vertices:
-            stored_vertices.append(mathutils.Vector(vert.co))
+        neutral_form = algorithms.get_vertices_coords(obj)
+        shapekey_form = numpy.empty_like(neutral_form)
 
         algorithms.print_log_report("INFO","Storing neutral character...OK")
         counter = 0
-        for morph_name in sorted(self.morph_data.keys()):
+        for morph_name in sorted(self.morph_rows.keys()):
             if "Expression" in morph_name:
                 counter += 1
-                self.calculate_morph(morph_name, 1.0)
                 algorithms.print_log_report("INFO","Converting {} to shapekey".format(morph_name))
-                self.update(update_all_verts=True)
-                new_sk = algorithms.new_shapekey_from_current_vertices(obj, morph_name)
-                new_sk.value = 0               
-
-                #Restore the neutral expression
-                for i in range(len(self.final_form)):
-                    self.final_form[i] = stored_vertices[i]
-                self.update(update_all_verts=True)
+                #The key is built from the neutral form, without changing the mesh
+                morph_indices, morph_deltas = self.get_morph(morph_name)
+                shapekey_form[:] = neutral_form
+                numpy.add.at(shapekey_form, morph_indices, morph_deltas)
+                new_sk = algorithms.new_shapekey_from_coords(obj, morph_name, shapekey_form)
+                new_sk.value = 0
         algorithms.print_log_report("INFO","Successfully converted {0} morphs in shapekeys".format(counter))
 
 
@@ -334,26 +459,27 @@ class MorphingEngine:
 
     def update(self, update_all_verts=False):
         obj = self.get_object()
-        vertices = obj.data.vertices
         if update_all_verts == True:
-            for i in range(len(self.final_form)):
-                vertices[i].co = self.final_form[i]
-        else:
-            for i in self.verts_to_update:
-                vertices[i].co = self.final_form[i]
+            algorithms.set_vertices_coords(obj, self.final_form)
+        elif self.verts_to_update.any():
+            #Only the dirty vertices are taken from final_form, the
+            #others keep the coordinates they have in the mesh
+            algorithms.get_vertices_coords(obj, self.mesh_form)
+            numpy.copyto(self.mesh_form, self.final_form, where=self.verts_to_update[:, None])
+            algorithms.set_vertices_coords(obj, self.mesh_form)
+
+    def clean_verts_to_update(self):
+        self.verts_to_update.fill(False)
 
     def copy_in_cache(self):
         obj = self.get_object()
         self.clean_the_cache()
-        vertices = obj.data.vertices
-        for i in range(len(self.final_form)):
-            self.cache_form.append(vertices[i].co.copy())
+        self.cache_form = algorithms.get_vertices_coords(obj)
         algorithms.print_log_report("INFO","Mesh cached")
 
     def copy_from_cache(self):
         if len(self.final_form) == len(self.cache_form):
-            for i in range(len(self.final_form)):
-                self.final_form[i] = self.cache_form[i]
+            self.final_form[:] = self.cache_form
             algorithms.print_log_report("INFO","Mesh copied from cache")
         else:
             algorithms.print_log_report("WARNING","Cached mesh not found")
@@ -362,18 +488,47 @@ class MorphingEngine:
         self.cache_form = []
 
 
+    def apply_morph_values(self, morph_values):
+        """
+        Set all the morphs at once, computing final_form = base_form + W·Δ
+        with one sparse-dense product for each database.
+        The morphs not in morph_values keep their current value.
+        """
+        time1 = time.time()
+        for morph_name, val in morph_values.items():
+            if morph_name in self.morph_rows:
+                self.morph_values[morph_name] = val
+
+        n_verts = len(self.base_form)
+        new_form = self.base_form.astype(numpy.float64)
+        databases_weights = {}
+        for morph_name, val in self.morph_values.items():
+            if val != 0.0:
+                if morph_name in self.morph_data_cache:
+                    #Corrected morphs differ from the deltas stored in the database
+                    morph_indices, morph_deltas = self.morph_data[morph_name]
+                    numpy.add.at(new_form, morph_indices, morph_deltas*val)
+                else:
+                    m_database, row = self.morph_rows[morph_name]
+                    if m_database not in databases_weights:
+                        databases_weights[m_database] = numpy.zeros(len(m_database), dtype=numpy.float32)
+                    databases_weights[m_database][row] = val
+
+        for m_database, weights in databases_weights.items():
+            new_form += m_database.weighted_sum(weights, n_verts)
+        self.final_form[:n_verts] = new_form
+        self.verts_to_update.fill(True)
+        algorithms.print_log_report("DEBUG","Morphs applied in {0} secs".format(time.time()-time1))
+
     def calculate_morph(self, morph_name, val, add_vertices_to_update=True):
 
-        if morph_name in self.morph_data:
+        if morph_name in self.morph_rows:
             real_val = val - self.morph_values[morph_name]
             if real_val != 0.0:
-                morph = self.morph_data[morph_name]
-                for d_data in morph:
-                    i = d_data[0]
-                    delta = d_data[1]
-                    self.final_form[i] = self.final_form[i] + delta*real_val
+                morph_indices, morph_deltas = self.get_morph(morph_name)
+                numpy.add.at(self.final_form, morph_indices, morph_deltas*real_val)
                 if add_vertices_to_update:
-                    self.verts_to_update = self.verts_to_update.union(self.morph_modified_verts[morph_name])
+                    self.verts_to_update[morph_indices] = True
                 self.morph_values[morph_name] = val
         else:
             algorithms.print_log_report("DEBUG","Morph data {0} not found".format(morph_name))
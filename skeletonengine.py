@@ -15,12 +15,102 @@
 
 import bpy, os, json
 import mathutils
-from . import algorithms
+import numpy
+from . import algorithms, dataloader, morphdatabase
+
+
+SKELETON_TEMPLATES = {
+    "base": "MBLab_skeleton_base_fk",
+    "ik": "MBLab_skeleton_base_ik",
+    "muscle": "MBLab_skeleton_muscle_fk",
+    "muscle_ik": "MBLab_skeleton_muscle_ik"}
+
+
+def get_z_axis_cache_file(skeleton_template_name):
+    cache_path = algorithms.get_cache_path()
+    if cache_path:
+        return os.path.join(cache_path, skeleton_template_name+"_z_axis.json")
+    return None
+
+
+def get_library_signature():
+    """
+    Size and modification time of the blend library: the cached
+    z axes are valid only for the library they were read from.
+    """
+    lib_filepath = algorithms.get_blendlibrary_path()
+    if lib_filepath and os.path.isfile(lib_filepath):
+        lib_stat = os.stat(lib_filepath)
+        return [lib_stat.st_size, lib_stat.st_mtime]
+    return None
+
+
+def load_z_axis_cache(cache_file, signature):
+    if signature and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "r") as c_file:
+                cache_data = json.load(c_file)
+            if cache_data["signature"] == signature:
+                return cache_data["z_axis"]
+        except (OSError, ValueError, KeyError):
+            algorithms.print_log_report("WARNING","Corrupted bones z axis cache {0}".format(algorithms.simple_path(cache_file)))
+    return None
+
+
+def preload_databases(data_loader, character_config, rigging_type):
+    data_path = algorithms.get_data_path()
+    if rigging_type in ("muscle", "muscle_ik"):
+        groups_filename = character_config["vertexgroup_muscle_file"]
+    else:
+        groups_filename = character_config["vertexgroup_base_file"]
+    joints_data_path = os.path.join(data_path,"joints",character_config["joints_base_file"])
+    joints_offset_data_path = os.path.join(data_path,"joints",character_config["joints_offset_file"])
+    vgroup_data_path = os.path.join(data_path,"vgroups",groups_filename)
+    data_loader.submit("joints", joints_data_path, algorithms.load_json_data, joints_data_path, "Joints data")
+    data_loader.submit("joints", joints_offset_data_path, algorithms.load_json_data, joints_offset_data_path, "Joints offset data")
+    if rigging_type in SKELETON_TEMPLATES:
+        z_axis_cache_file = get_z_axis_cache_file(SKELETON_TEMPLATES[rigging_type])
+        if z_axis_cache_file:
+            data_loader.submit("joints", z_axis_cache_file, load_z_axis_cache, z_axis_cache_file, get_library_signature())
+    data_loader.submit("vgroups", vgroup_data_path, load_vgroups_data, vgroup_data_path)
+
+
+def load_vgroups_data(filepath, use_weights=True):
+    """
+    Load the vertex groups, converting each group in the arrays of
+    its vertex indices and weights. If a vertex is listed more than
+    once, the last weight is used, as the 'REPLACE' mode does.
+    """
+    g_data = algorithms.load_json_data(filepath, "Vertgroups data")
+    if not g_data:
+        return g_data
+    vgroups_data = {}
+    for group_name, group_data in g_data.items():
+        indices = []
+        weights = []
+        for vert_data in group_data:
+            if use_weights:
+                if type(vert_data) == list:
+                    indices.append(vert_data[0])
+                    weights.append(vert_data[1])
+                else:
+                    algorithms.print_log_report("INFO","Error: wrong format for vert weight")
+            else:
+                if type(vert_data) == int:
+                    indices.append(vert_data)
+                    weights.append(1.0)
+                else:
+                    algorithms.print_log_report("INFO","Error: wrong format for vert group")
+        indices = numpy.array(indices, dtype=numpy.int32)
+        weights = numpy.array(weights, dtype=numpy.float32)
+        unique_indices, last_positions = numpy.unique(indices[::-1], return_index=True)
+        vgroups_data[group_name] = (unique_indices, weights[::-1][last_positions])
+    return vgroups_data
 
 
 class SkeletonEngine:
 
-    def __init__(self, obj_body,character_config,rigging_type):
+    def __init__(self, obj_body,character_config,rigging_type,data_loader=None):
         self.has_data = False
         self.data_path = algorithms.get_data_path()
         #characters_config = algorithms.get_configuration()
@@ -34,18 +124,11 @@ class SkeletonEngine:
             self.joints_filename = character_config["joints_base_file"]
             self.joints_offset_filename = character_config["joints_offset_file"]
 
-            if rigging_type == "base":
-                self.skeleton_template_name = "MBLab_skeleton_base_fk"
-                self.groups_filename = character_config["vertexgroup_base_file"]
-            if rigging_type == "ik":
-                self.skeleton_template_name = "MBLab_skeleton_base_ik"
+            if rigging_type in SKELETON_TEMPLATES:
+                self.skeleton_template_name = SKELETON_TEMPLATES[rigging_type]
+            if rigging_type in ("base", "ik"):
                 self.groups_filename = character_config["vertexgroup_base_file"]
-
-            if rigging_type == "muscle":
-                self.skeleton_template_name = "MBLab_skeleton_muscle_fk"
-                self.groups_filename = character_config["vertexgroup_muscle_file"]
-            if rigging_type == "muscle_ik":
-                self.skeleton_template_name = "MBLab_skeleton_muscle_ik"
+            if rigging_type in ("muscle", "muscle_ik"):
                 self.groups_filename = character_config["vertexgroup_muscle_file"]
 
 
@@ -54,8 +137,12 @@ class SkeletonEngine:
             self.joints_data_path = os.path.join(self.data_path,"joints",self.joints_filename)
             self.joints_offset_data_path = os.path.join(self.data_path,"joints",self.joints_offset_filename)
             self.vgroup_data_path = os.path.join(self.data_path,"vgroups",self.groups_filename)
-            self.joints_database = algorithms.load_json_data(self.joints_data_path,"Joints data")
-            self.joints_offset_database = algorithms.load_json_data(self.joints_offset_data_path,"Joints offset data")
+            self.z_axis_cache_file = get_z_axis_cache_file(self.skeleton_template_name)
+            self.joints_database = dataloader.get_data(data_loader, self.joints_data_path, algorithms.load_json_data, self.joints_data_path, "Joints data")
+            self.joints_offset_database = dataloader.get_data(data_loader, self.joints_offset_data_path, algorithms.load_json_data, self.joints_offset_data_path, "Joints offset data")
+            self.joints = morphdatabase.JointsDatabase(self.joints_database or {}, self.joints_offset_database)
+            self.joints_bones = [joint_name.rsplit("_", 1)[0] for joint_name in self.joints.names]
+            self.joints_snapshot = None
 
             if self.check_skeleton(obj_body):
                 obj_armat = algorithms.get_object_parent(obj_body)
@@ -64,7 +151,7 @@ class SkeletonEngine:
 
 
             if obj_armat != None:
-                self.store_z_axis()
+                self.store_z_axis(data_loader)
                 # TODO doesn't look like armature_visibility is used
                 # anywhere
                 #self.armature_visibility = [x for x in obj_armat.layers]
@@ -72,7 +159,7 @@ class SkeletonEngine:
                 self.align_bones_z_axis()
                 obj_body.parent = obj_armat
                 self.has_data = True
-            self.load_groups(self.vgroup_data_path)
+            self.load_groups(self.vgroup_data_path, data_loader=data_loader)
             self.add_armature_modifier()
 
     def check_skeleton(self, obj_body):
@@ -110,51 +197,83 @@ class SkeletonEngine:
             algorithms.select_and_change_mode(armat,'POSE')
             bpy.ops.pose.armature_apply()
             algorithms.select_and_change_mode(obj,'OBJECT')
+            self.joints_snapshot = None
 
     def error_msg(self, path):
         algorithms.print_log_report("ERROR","Database file not found: {0}".format(algorithms.simple_path(path)))
 
-    def store_z_axis(self):
+    def store_z_axis(self, data_loader=None):
+        """
+        Read the z axis of the bones of the original skeleton from
+        the cache. If the cache is missing or was created from a
+        different library, the skeleton is imported from the library
+        and the cache is written for the next sessions.
+        """
+        self.armature_z_axis = {}
+        signature = get_library_signature()
+        z_axis_data = None
+        if self.z_axis_cache_file:
+            z_axis_data = dataloader.get_data(data_loader, self.z_axis_cache_file, load_z_axis_cache, self.z_axis_cache_file, signature)
+        if z_axis_data:
+            for bone_name, z_axis in z_axis_data.items():
+                self.armature_z_axis[bone_name] = mathutils.Vector(z_axis)
+            return
+
         algorithms.print_log_report("INFO","Importing temporary original skeleton to store z axis")
         native_armature = algorithms.import_object_from_lib(self.lib_filepath, self.skeleton_template_name, "temp_armature")
 
         if native_armature:
             self.armature_z_axis = algorithms.get_all_bones_z_axis(native_armature)
             algorithms.remove_object(native_armature)
-
-    def align_bones_z_axis(self):
+            if self.z_axis_cache_file and signature:
+                self.save_z_axis_cache(signature)
+
+    def save_z_axis_cache(self, signature):
+        z_axis_data = {}
+        for bone_name, z_axis in self.armature_z_axis.items():
+            z_axis_data[bone_name] = list(z_axis)
+        temp_path = "{0}.{1}.tmp".format(self.z_axis_cache_file, os.getpid())
+        try:
+            with open(temp_path, "w") as c_file:
+                json.dump({"signature":signature, "z_axis":z_axis_data}, c_file)
+            os.replace(temp_path, self.z_axis_cache_file)
+            algorithms.print_log_report("INFO","Bones z axis cached in {0}".format(algorithms.simple_path(self.z_axis_cache_file)))
+        except OSError:
+            algorithms.print_log_report("WARNING","Cannot write the bones z axis cache {0}".format(algorithms.simple_path(self.z_axis_cache_file)))
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def align_bones_z_axis(self, bone_names=None):
         target_armature = self.get_armature()
         if target_armature:
             algorithms.select_and_change_mode(target_armature,'EDIT')
             edit_bones = algorithms.get_edit_bones(target_armature)
-            for e_bone in edit_bones:                
+            for e_bone in edit_bones:
+                if bone_names is not None and e_bone.name not in bone_names:
+                    continue
                 if e_bone.name in self.armature_z_axis:
                     z_axis = self.armature_z_axis[e_bone.name]
                     e_bone.align_roll(z_axis)
             algorithms.select_and_change_mode(target_armature,'POSE')
 
-    def load_groups(self,filepath,use_weights = True,clear_all=True):
+    def load_groups(self,filepath,use_weights = True,clear_all=True,data_loader=None):
         if self.has_data:
             obj = self.get_body()
-            g_data = algorithms.load_json_data(filepath,"Vertgroups data")
+            if use_weights:
+                g_data = dataloader.get_data(data_loader, filepath, load_vgroups_data, filepath)
+            else:
+                g_data = load_vgroups_data(filepath, use_weights)
 
             if clear_all:
                 algorithms.remove_vertgroups_all(obj)
             if g_data:
+                vertgroups_weights = []
                 group_names = sorted(g_data.keys())
                 for group_name in group_names:
                     new_group = algorithms.new_vertgroup(obj, group_name)
-                    for vert_data in g_data[group_name]:
-                        if use_weights:
-                            if type(vert_data) == list:                                
-                                new_group.add([vert_data[0]], vert_data[1], 'REPLACE')
-                            else:
-                                algorithms.print_log_report("INFO","Error: wrong format for vert weight")
-                        else:
-                            if type(vert_data) == int:                                
-                                new_group.add([vert_data], 1.0, 'REPLACE')
-                            else:
-                                algorithms.print_log_report("INFO","Error: wrong format for vert group")
+                    indices, weights = g_data[group_name]
+                    vertgroups_weights.append((new_group, indices, weights))
+                algorithms.set_vertgroups_weights(obj, vertgroups_weights)
 
                 algorithms.print_log_report("INFO","Group loaded from {0}".format(algorithms.simple_path(filepath)))
             else:
@@ -177,54 +296,52 @@ class SkeletonEngine:
         else:
             return False
 
-    def calculate_joint_location(self,obj,vertsindex_list):
-        joint_verts_coords = []
-        for v_idx in vertsindex_list:
-            vert = obj.data.vertices[v_idx]
-            joint_verts_coords.append(vert.co)
-        return algorithms.average_center(joint_verts_coords)
-
-    def fit_joints(self):
-
+    def fit_joints(self, verts_coo=None, force=False):
+        """
+        Move the bones to the joints. The locations are calculated
+        from verts_coo or, if it is None, from the mesh vertices.
+        Only the bones with a joint moved since the last fitting are
+        changed, and Blender is not touched if no joint moved, unless
+        force is True.
+        """
         armat = self.get_armature()
         body = self.get_body()
 
         if armat and body:
+            if verts_coo is None:
+                verts_coo = algorithms.get_vertices_coords(body)
+            joints_locations = self.joints.joints_locations(verts_coo)
+
+            if force or self.joints_snapshot is None:
+                moved_rows = range(len(self.joints))
+            else:
+                moved_rows = numpy.flatnonzero(numpy.any(
+                    numpy.abs(joints_locations-self.joints_snapshot) > 1e-6, axis=1)).tolist()
+                if not moved_rows:
+                    return
+            self.joints_snapshot = joints_locations
+            joints_locations = joints_locations.tolist()
+
+            moved_bones = {}
+            for row in moved_rows:
+                moved_bones.setdefault(self.joints_bones[row], []).append(row)
+
             algorithms.set_object_visible(armat)
-            algorithms.print_log_report("DEBUG","Fitting armature {0}".format(armat.name))
+            algorithms.print_log_report("DEBUG","Fitting {0} bones of armature {1}".format(len(moved_bones), armat.name))
             armat.data.use_mirror_x = False
             current_active_obj = algorithms.get_active_object()
             algorithms.select_and_change_mode(armat,"EDIT")
             edit_bones = algorithms.get_edit_bones(armat)
-            for e_bone in edit_bones:
-                tail_name = "".join((e_bone.name, "_tail"))
-                head_name = "".join((e_bone.name, "_head"))
-
-                if tail_name in self.joints_database:
-                    tail_location = self.calculate_joint_location(body, self.joints_database[tail_name])
-
-                    if self.joints_offset_database:
-                        if tail_name in self.joints_offset_database:
-                            tail_delta = mathutils.Vector(self.joints_offset_database[tail_name])
-                            tail_location += tail_delta
-                    e_bone.tail = tail_location
-
-                if head_name in self.joints_database:
-                    head_location = self.calculate_joint_location(body, self.joints_database[head_name])
-
-                    if self.joints_offset_database:
-                        if head_name in self.joints_offset_database:
-                            head_delta = mathutils.Vector(self.joints_offset_database[head_name])
-                            head_location += head_delta
-                    e_bone.head = head_location
+            for bone_name, rows in moved_bones.items():
+                if bone_name in edit_bones:
+                    e_bone = edit_bones[bone_name]
+                    for row in rows:
+                        if self.joints.names[row].endswith("_tail"):
+                            e_bone.tail = joints_locations[row]
+                        elif self.joints.names[row].endswith("_head"):
+                            e_bone.head = joints_locations[row]
 
             algorithms.select_and_change_mode(armat,"OBJECT")
-            self.align_bones_z_axis()
+            self.align_bones_z_axis(moved_bones)
             algorithms.update_bendy_bones(armat)
             algorithms.set_active_object(current_active_obj)
-
-
-
-
-
-